@@ -1,3 +1,4 @@
+import cookielib
 import csv
 import getpass
 import os
@@ -41,9 +42,9 @@ class GoogleVoiceLogin:
 			import getpass
 			password = getpass.getpass("Please enter your Google Account password: ")
 
-		# Set up our opener
-		self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor())
-		urllib2.install_opener(self.opener)
+		# Set up our own opener rather than replacing the process wide one
+		self.cookie_jar = cookielib.CookieJar()
+		self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.cookie_jar))
 
 		# Define URLs
 		self.login_page_url = 'https://accounts.google.com/ServiceLogin?service=grandcentral'
@@ -335,6 +336,9 @@ class NumberDialer():
 ##############################################################################
 ##############################################################################
 
+# Seconds to wait between texts
+SEND_INTERVAL = 5
+
 # Function used to create a separator
 def separator():
 	return '-' * 25
@@ -354,8 +358,23 @@ def clear_screen():
 		# Windows
 		os.system('CLS')
 
+# Parse the command line options
+def parse_args(argv = None):
+	import argparse
+	parser = argparse.ArgumentParser(description = "Send a text or place a call to every member of a Google Contacts group.")
+	parser.add_argument('--dry-run', action = 'store_true',
+						help = "simulate the texts instead of sending them and report the projected duration (needs gvsimulate.py alongside this script)")
+	parser.add_argument('--latency', type = float, default = 1.0, metavar = 'SECONDS',
+						help = "mean request latency to assume in a dry run")
+	parser.add_argument('--failure-rate', type = float, default = 0.0, metavar = 'RATE',
+						help = "fraction of texts to assume fail in a dry run")
+	parser.add_argument('--suppress', metavar = 'FILE',
+						help = "never text or call the numbers listed in FILE, one per line (needs gvsuppress.py alongside this script)")
+	return parser.parse_args(argv)
+
 # Main method to be run		
-def main():
+def main(argv = None):
+	options = parse_args(argv)
 	# Log in
 	gv_login = GoogleVoiceLogin()
 	if not gv_login.logged_in:
@@ -364,6 +383,11 @@ def main():
 	else:
 		print "Login successful!"
 
+	suppression_list = None
+	if options.suppress:
+		import gvsuppress
+		suppression_list = gvsuppress.SuppressionList.load(options.suppress)
+
 	# Use the ContactLoader to download Google Contacts		
 	contact_loader = ContactLoader(gv_login)
 
@@ -421,13 +445,21 @@ def main():
 	# Send texts to all people in contact list	
 	if (selected_option == 1):
 		print separator()
-		text_sender = TextSender(gv_login)
+		if options.dry_run:
+			import gvsimulate
+			latency_model = gvsimulate.LatencyModel(options.latency, failure_rate = options.failure_rate)
+			# The loop below waits after every contact, so pace is left to it
+			text_sender = gvsimulate.SimulatedTextSender(latency_model)
+		else:
+			text_sender = TextSender(gv_login)
 		text = raw_input("Enter text message. Press enter when finished: ")
 		text_sender.text = text
 		for contact in contact_selector.get_contacts_list():
 			number = contact[1].mobile
 			if number == '':
 				print "{0} does not have a mobile number".format(contact[1])
+			elif suppression_list is not None and suppression_list.is_suppressed(number):
+				print "{0} is on the suppression list, skipped".format(contact[1])
 			else:
 				print "Sending message to {0} at {1}...".format(contact[1], contact[1].mobile),
 				text_sender.send_text(contact[1].mobile)
@@ -435,12 +467,21 @@ def main():
 					print "Success!"
 				else:
 					print "Failed!!"
-			print "Waiting 5 seconds to send next..."
-			time.sleep(5)
+			if options.dry_run:
+				text_sender.wait(SEND_INTERVAL)
+			else:
+				print "Waiting {0} seconds to send next...".format(SEND_INTERVAL)
+				time.sleep(SEND_INTERVAL)
+		if options.dry_run:
+			print separator()
+			print text_sender.report()
 
 	# Call all people in contact list					
 	elif (selected_option == 2):
 		print separator()
+		if options.dry_run:
+			print "Dry run - calls are not simulated, nothing was dialed."
+			return
 		number_dialer = NumberDialer(gv_login)
 
 		number_retriever = NumberRetriever(gv_login)
@@ -472,6 +513,8 @@ def main():
 			number = contact[1].mobile
 			if number == '':
 				print "{0} does not have a mobile number".format(contact[1])
+			elif suppression_list is not None and suppression_list.is_suppressed(number):
+				print "{0} is on the suppression list, skipped".format(contact[1])
 			else:
 				input = None
 				while input not in ['', 'n', 'N', 'q', 'Q'] :
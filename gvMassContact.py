@@ -3,6 +3,15 @@ import getpass
 import sys
 import re
 import os
+import time
+import argparse
+
+import gvpicker
+import gvresults
+import gvsimulate
+import gvsnapshot
+import gvsuppress
+import gvtrace
 
 # Function used to create a separator
 def separator():
@@ -17,30 +26,98 @@ def get_numeric_input(prompt):
 # Function to clear the screen 
 def clear_screen():
 	if os.name == "posix":
-		# *nix systems
-		os.system('clear')
+		# *nix systems, no need to start a process for this
+		if sys.stdout.isatty():
+			sys.stdout.write("\033[H\033[2J")
+			sys.stdout.flush()
 	elif os.name in ("nt", "dos", "ce"):
 		# Windows
 		os.system('CLS')
 
-# Main method to be run		
-def main():
-	# Log in
-
-	gv_login = GoogleVoiceLogin()
-	if not gv_login.logged_in:
-		print "Could not log in with provided credentials"
-		sys.exit(1)
+# Print a per recipient message, unless running quietly
+def say(options, message, newline = True):
+	if options.quiet:
+		return
+	if newline:
+		print message
 	else:
-		print "Login successful!"
+		print message,
 
-	# Use the ContactLoader to download Google Contacts		
-	contact_loader = ContactLoader(gv_login)
+# Check a number against the login's suppression list, if any. A number
+# held back is recorded with the "suppressed" outcome, as TextSender and
+# NumberDialer would have done
+def is_suppressed(gv_login, action, number, contact):
+	if gv_login.suppression_list is None or not gv_login.suppression_list.is_suppressed(number):
+		return False
+	gv_login.record_result(action, number, str(contact), time.time(), 'suppressed')
+	return True
 
-	# Use the ContactSelector to select the group and 
-	# final list of contacts to contact
-	contact_selector = ContactSelector(contact_loader)
+# Parse the command line options
+def parse_args(argv = None):
+	parser = argparse.ArgumentParser(description = "Send a text or place a call to every member of a Google Contacts group.")
+	parser.add_argument('--trace', metavar = 'FILE',
+						help = "write a Chrome trace-event timeline of the run to FILE (same as setting GVOICE_TRACE)")
+	parser.add_argument('--group', action = 'append', metavar = 'NAME',
+						help = "only download this contact group (may be repeated) instead of every contact")
+	parser.add_argument('--cache-dir', metavar = 'DIR',
+						help = "keep each downloaded group in DIR and reuse it for an hour")
+	parser.add_argument('--snapshot', metavar = 'FILE',
+						help = "read the contacts from snapshot FILE instead of downloading them, creating it if missing "
+							   "or made for other --group options")
+	parser.add_argument('--refresh-snapshot', action = 'store_true',
+						help = "download the contacts and rewrite the --snapshot file")
+	parser.add_argument('--suppress', metavar = 'FILE',
+						help = "never text or call the numbers listed in FILE (one per line)")
+	parser.add_argument('--results', metavar = 'FILE',
+						help = "record the outcome of every text and call in FILE (.jsonl, .csv or .db for SQLite)")
+	parser.add_argument('--rotate-mb', type = int, default = 0, metavar = 'MB',
+						help = "start a new results file once it reaches MB megabytes")
+	parser.add_argument('--rotate-daily', action = 'store_true',
+						help = "start a new results file every day")
+	parser.add_argument('--quiet', action = 'store_true',
+						help = "print a summary instead of a line per recipient")
+	parser.add_argument('--dry-run', action = 'store_true',
+						help = "go through the whole run but simulate the texts instead of sending them, then report the projected duration")
+	parser.add_argument('--pace', type = float, default = 0, metavar = 'SECONDS',
+						help = "delay between texts to assume in a dry run (gvAllInOne.py waits 5)")
+	parser.add_argument('--latency', type = float, default = 1.0, metavar = 'SECONDS',
+						help = "mean request latency to assume in a dry run")
+	parser.add_argument('--jitter', type = float, default = 0.0, metavar = 'SECONDS',
+						help = "standard deviation of the request latency in a dry run")
+	parser.add_argument('--failure-rate', type = float, default = 0.0, metavar = 'RATE',
+						help = "fraction of texts to assume fail in a dry run")
+	parser.add_argument('--latency-from', metavar = 'TRACE',
+						help = "replay the latencies and outcomes recorded in a --trace file instead")
+	parser.add_argument('--seed', type = int,
+						help = "random seed for a repeatable dry run")
+	return parser.parse_args(argv)
 
+# Build the sender the send loop will use
+def create_text_sender(gv_login, options):
+	if not options.dry_run:
+		return TextSender(gv_login)
+	if options.latency_from:
+		latency_model = gvsimulate.LatencyModel.from_trace(options.latency_from, seed = options.seed)
+	else:
+		latency_model = gvsimulate.LatencyModel(options.latency, options.jitter,
+												options.failure_rate, seed = options.seed)
+	return gvsimulate.SimulatedTextSender(latency_model, options.pace)
+
+# Open a contacts snapshot, unless it is of an older format or was made
+# for other groups than those asked for, in which case return None
+def open_snapshot(path, groups):
+	try:
+		contact_loader = gvsnapshot.SnapshotContactLoader(path)
+	except ValueError:
+		return None
+	if contact_loader.groups != (sorted(set(groups)) if groups else None):
+		contact_loader.snapshot.close()
+		return None
+	return contact_loader
+
+# Walk the user through picking a group, trimming it down and choosing
+# an action. Returns the selected option (1: text, 2: call)
+def select_contacts(contact_selector):
 	clear_screen()
 	group_list = contact_selector.get_group_list()
 	selected_group = None
@@ -55,22 +132,9 @@ def main():
 	clear_screen()
 	# Now that a group is selected, narrow down the list of people in the group
 	contact_selector.set_selected_group(selected_group)
-	removing = True
-	while removing:
-		print "Contact List"
-		print separator()
-		for contact_item in contact_selector.get_contacts_list():
-			print "{0}: {1}".format(contact_item[0], contact_item[1])
-		print separator()
-		try:
-			input_list = raw_input("Enter a list of the indexes (coma, space or otherwise delimeted)\nof those contacts you DO NOT wish to contact this session.\nPress enter when finished:  ")
-			if input_list != '':
-				contacts_to_remove_list = [int(match.group(1)) for match in re.finditer(r"(\d+)", input_list)]
-				contact_selector.remove_from_contact_list(contacts_to_remove_list)
-			else:
-				removing = False
-		except:
-			pass
+	print "Contact List - choose the contacts you DO NOT wish to contact this session"
+	contact_picker = gvpicker.ContactPicker(contact_selector.contact_list)
+	contact_selector.remove_from_contact_list(contact_picker.run())
 
 	clear_screen()
 	# Print final list
@@ -87,28 +151,94 @@ def main():
 		print "2: Call"
 		print separator()
 		selected_option = get_numeric_input("Select which action to take: ")
+	return selected_option
+
+# Main method to be run		
+def main(argv = None):
+	options = parse_args(argv)
+	if options.trace:
+		gvtrace.enable(options.trace)
+
+	with gvtrace.span('run'):
+		run(options)
+
+def run(options):
+	# Log in
+	with gvtrace.span('login'):
+		gv_login = GoogleVoiceLogin()
+	if not gv_login.logged_in:
+		print "Could not log in with provided credentials"
+		sys.exit(1)
+	else:
+		print "Login successful!"
+
+	if options.suppress:
+		with gvtrace.span('load suppression list'):
+			gv_login.suppression_list = gvsuppress.SuppressionList.load(options.suppress)
+	if options.results and not options.dry_run:
+		gv_login.results_sink = gvresults.open_sink(options.results, options.rotate_mb * 1024 * 1024,
+													daily = options.rotate_daily)
+	try:
+		run_campaign(gv_login, options)
+	finally:
+		if gv_login.results_sink is not None:
+			gv_login.results_sink.close()
+
+def run_campaign(gv_login, options):
+	# Use the ContactLoader to download Google Contacts, or open the snapshot
+	# of them saved by an earlier run
+	with gvtrace.span('load contacts'):
+		contact_loader = None
+		if options.snapshot and os.path.exists(options.snapshot) and not options.refresh_snapshot:
+			contact_loader = open_snapshot(options.snapshot, options.group)
+		if contact_loader is None:
+			contact_loader = ContactLoader(gv_login, options.group, options.cache_dir)
+			if options.snapshot:
+				gvsnapshot.write_snapshot(contact_loader, options.snapshot)
+
+	# Use the ContactSelector to select the group and 
+	# final list of contacts to contact
+	contact_selector = ContactSelector(contact_loader)
+
+	with gvtrace.span('selection'):
+		selected_option = select_contacts(contact_selector)
 
 	# Send texts to all people in contact list	
 	if (selected_option == 1):
 		print separator()
-		text_sender = TextSender(gv_login)
+		text_sender = create_text_sender(gv_login, options)
 		text = raw_input("Enter text message. Press enter when finished: ")
 		text_sender.text = text
-		for contact in contact_selector.get_contacts_list():
-			number = contact[1].mobile
-			if number == '':
-				print "{0} does not have a mobile number".format(contact[1])
-			else:
-				print "Sending message to {0} at {1}...".format(contact[1], contact[1].mobile),
-				text_sender.send_text(contact[1].mobile)
-				if text_sender.response:
-					print "Success!"
+		sent = failed = skipped = 0
+		with gvtrace.span('send loop'):
+			for contact in contact_selector.get_contacts_list():
+				number = contact[1].mobile
+				if number == '':
+					say(options, "{0} does not have a mobile number".format(contact[1]))
+					skipped += 1
+				elif is_suppressed(gv_login, 'text', number, contact[1]):
+					say(options, "{0} is on the suppression list, skipped".format(contact[1]))
+					skipped += 1
 				else:
-					print "Failed!!"
+					say(options, "Sending message to {0} at {1}...".format(contact[1], contact[1].mobile), False)
+					text_sender.send_text(contact[1].mobile, contact_name = str(contact[1]))
+					if text_sender.response:
+						say(options, "Success!")
+						sent += 1
+					else:
+						say(options, "Failed!!")
+						failed += 1
+		print "Sent {0}, failed {1}, skipped {2}".format(sent, failed, skipped)
+		if options.dry_run:
+			print separator()
+			print text_sender.report()
 
 	# Call all people in contact list					
 	elif (selected_option == 2):
 		print separator()
+		if options.dry_run:
+			print "Dry run - calls are not simulated, nothing was dialed."
+			return
 		number_dialer = NumberDialer(gv_login)
 
 		number_retriever = NumberRetriever(gv_login)
@@ -136,13 +266,15 @@ def main():
 			number = contact[1].mobile
 			if number == '':
 				print "{0} does not have a mobile number".format(contact[1])
+			elif is_suppressed(gv_login, 'call', number, contact[1]):
+				print "{0} is on the suppression list, skipped".format(contact[1])
 			else:
 				input = None
 				while input not in ['', 'n', 'N', 'q', 'Q'] :
 					input = raw_input("Press enter to call {0} at {1} ('n' to skip, 'q' to quit): ".format(contact[1], contact[1].mobile))
 				if input == '':
 					print "Calling {0}....".format(contact[1]),
-					number_dialer.place_call(number)
+					number_dialer.place_call(number, contact_name = str(contact[1]))
 					if number_dialer.response:
 						print "Success!"
 					else:
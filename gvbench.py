@@ -0,0 +1,349 @@
+"""
+gvbench.py
+
+Offline micro-benchmarks for the contact pipeline in gvoice.py
+and the gvsnapshot warm start.
+
+Synthetic Outlook CSV exports and phones settings pages are generated
+for each size, then fed to ContactLoader, ContactSelector and
+NumberRetriever through a stand in opener, so nothing touches the
+network. Every measurement runs in its own process, which keeps the
+peak memory figures from one size out of the next. The inputs are
+written to temporary files by a separate process beforehand, so making
+them does not count towards the measured memory either.
+
+Peak memory is reported as the growth of the peak resident set size
+over the resident size when the measurement starts. On Linux the peak
+is reset at that point, so any setup a benchmark needs (ie loading the
+contacts before timing ContactSelector) is left out of the figure.
+
+Results are written as JSON so they can be compared between versions:
+
+	python gvbench.py --sizes 1000 10000 --output before.json
+	git checkout my-branch
+	python gvbench.py --sizes 1000 10000 --output after.json
+"""
+
+import Queue
+import StringIO
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+from gvoice import *
+import gvsnapshot
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+FIRST_NAMES = ['James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda',
+			   'William', 'Elizabeth', 'David', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis',
+			  'Rodriguez', 'Martinez', 'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson']
+CSV_COLUMNS = ['First Name', 'Middle Name', 'Last Name', 'E-mail Address', 'Mobile Phone',
+			   'Home Phone', 'Business Phone', 'Categories', 'Notes']
+
+def generate_contacts_csv(rows, seed = 0):
+	"""
+	Return an Outlook CSV export of rows contacts.
+
+	Group sizes follow a long tail, as in real address books: a few
+	groups hold most people, most people are in one or two groups, about
+	one in ten is in none and about one in twenty has no first name (and
+	so is skipped by ContactLoader).
+	"""
+	generator = random.Random(seed)
+	groups = ['Group {0}'.format(number) for number in range(max(5, int(rows ** 0.5) // 4))]
+	weights = [1.0 / (rank + 1) for rank in range(len(groups))]
+	total = sum(weights)
+	cumulative = []
+	running = 0.0
+	for weight in weights:
+		running += weight / total
+		cumulative.append(running)
+
+	def pick_group():
+		target = generator.random()
+		for group, limit in zip(groups, cumulative):
+			if target <= limit:
+				return group
+		return groups[-1]
+
+	output = StringIO.StringIO()
+	writer = csv.writer(output)
+	writer.writerow(CSV_COLUMNS)
+	for row in xrange(rows):
+		membership = generator.random()
+		if membership < 0.1:
+			categories = ''
+		else:
+			count = 1 if membership < 0.7 else (2 if membership < 0.95 else 3)
+			categories = ';'.join(sorted(set(pick_group() for _ in range(count))))
+		first_name = '' if generator.random() < 0.05 else generator.choice(FIRST_NAMES)
+		last_name = '{0} {1}'.format(generator.choice(LAST_NAMES), row)
+		mobile = '' if generator.random() < 0.15 else '555-{0:03d}-{1:04d}'.format(row // 10000 % 1000, row % 10000)
+		writer.writerow([first_name, '', last_name, 'person{0}@example.com'.format(row), mobile,
+						 '', '', categories, ''])
+	return output.getvalue()
+
+def generate_phones_page(rows, seed = 0):
+	"""
+	Return a phones settings page listing rows phones.
+	"""
+	generator = random.Random(seed)
+	phones = {}
+	for phone_id in xrange(1, rows + 1):
+		phones[str(phone_id)] = {
+			'id': phone_id,
+			'type': generator.choice([1, 2, 3, 7]),
+			'name': 'Phone {0}'.format(phone_id),
+			'phoneNumber': '+1555{0:07d}'.format(phone_id),
+			'verified': True
+		}
+	return "<response><json><![CDATA[{0}]]></json><html></html></response>".format(json.dumps({'phones': phones}))
+
+class OfflineOpener():
+	"""
+	Opener which answers every request with the contents of the same
+	prepared file.
+	"""
+	def __init__(self, path):
+		self.path = path
+
+	def open(self, url, data = None):
+		return open(self.path, 'rb')
+
+class OfflineLogin():
+	"""
+	Stands in for a GoogleVoiceLogin, serving the file at path to
+	whatever asks.
+	"""
+	def __init__(self, path):
+		self.opener = OfflineOpener(path)
+		self.contact_tok = 'offline'
+		self.key = 'offline'
+		self.email = 'offline'
+
+def _proc_status_kb(field):
+	# Read a "Field:  1234 kB" line from /proc/self/status, None if unavailable
+	try:
+		with open('/proc/self/status') as status_file:
+			for line in status_file:
+				if line.startswith(field + ':'):
+					return int(line.split()[1])
+	except (IOError, OSError):
+		pass
+	return None
+
+def peak_rss_kb():
+	peak = _proc_status_kb('VmHWM')
+	if peak is not None:
+		return peak
+	# ru_maxrss is in kilobytes on Linux and bytes on OS X
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak // 1024 if sys.platform == 'darwin' else peak
+
+def start_memory():
+	"""
+	Begin a memory measurement: reset the peak resident size where the
+	platform allows (Linux 4.0 and later), and return the baseline to
+	subtract from peak_rss_kb() afterwards.
+	"""
+	try:
+		with open('/proc/self/clear_refs', 'w') as clear_refs:
+			clear_refs.write('5')
+	except (IOError, OSError):
+		# The peak so far can't be forgotten, so measure growth above it
+		return peak_rss_kb()
+	current = _proc_status_kb('VmRSS')
+	return current if current is not None else peak_rss_kb()
+
+def prepare_contacts(rows, seed, directory):
+	path = os.path.join(directory, 'contacts.csv')
+	with open(path, 'wb') as csv_file:
+		csv_file.write(generate_contacts_csv(rows, seed))
+	return path
+
+def prepare_phones(rows, seed, directory):
+	path = os.path.join(directory, 'phones.html')
+	with open(path, 'wb') as page_file:
+		page_file.write(generate_phones_page(rows, seed))
+	return path
+
+def prepare_snapshot(rows, seed, directory):
+	contact_loader = ContactLoader(OfflineLogin(prepare_contacts(rows, seed, directory)))
+	path = os.path.join(directory, 'contacts.snapshot')
+	gvsnapshot.write_snapshot(contact_loader, path)
+	return path
+
+def bench_contact_loader(path):
+	gv_login = OfflineLogin(path)
+	before = start_memory()
+	start = time.time()
+	contact_loader = ContactLoader(gv_login)
+	seconds = time.time() - start
+	contacts = sum(len(group) for group in contact_loader.contact_group.values())
+	return {'seconds': seconds, 'peak_rss_delta_kb': peak_rss_kb() - before,
+			'groups': len(contact_loader.contact_group), 'contacts': contacts}
+
+def bench_contact_selector(path):
+	contact_loader = ContactLoader(OfflineLogin(path))
+	contact_selector = ContactSelector(contact_loader)
+	# Work on the largest group, as a campaign to everyone would
+	largest = max(contact_loader.contacts_by_group_list, key = lambda item: len(item[1][1]))
+	before = start_memory()
+
+	start = time.time()
+	contact_selector.set_selected_group(largest[0])
+	contacts_list = contact_selector.get_contacts_list()
+	list_seconds = time.time() - start
+
+	# Remove every tenth contact in one go
+	to_remove = range(1, len(contacts_list) + 1, 10)
+	start = time.time()
+	contact_selector.remove_from_contact_list(to_remove)
+	remove_seconds = time.time() - start
+
+	return {'seconds': list_seconds + remove_seconds, 'get_contacts_list_seconds': list_seconds,
+			'remove_from_contact_list_seconds': remove_seconds, 'peak_rss_delta_kb': peak_rss_kb() - before,
+			'group_size': len(contacts_list), 'removed': len(to_remove)}
+
+def bench_number_retriever(path):
+	gv_login = OfflineLogin(path)
+	before = start_memory()
+	start = time.time()
+	number_retriever = NumberRetriever(gv_login)
+	phone_numbers = number_retriever.get_phone_numbers()
+	seconds = time.time() - start
+	return {'seconds': seconds, 'peak_rss_delta_kb': peak_rss_kb() - before, 'phones': len(phone_numbers)}
+
+def bench_snapshot_loader(path):
+	before = start_memory()
+	start = time.time()
+	snapshot_loader = gvsnapshot.SnapshotContactLoader(path)
+	open_seconds = time.time() - start
+	# Touch every member of the largest group, as a campaign to it would
+	largest = max(snapshot_loader.contact_group.values(), key = len)
+	start = time.time()
+	names = [str(contact) for contact in largest]
+	touch_seconds = time.time() - start
+	peak_rss_delta_kb = peak_rss_kb() - before
+	snapshot_loader.snapshot.close()
+	return {'seconds': open_seconds + touch_seconds, 'open_seconds': open_seconds,
+			'touch_largest_group_seconds': touch_seconds, 'peak_rss_delta_kb': peak_rss_delta_kb,
+			'group_size': len(names)}
+
+# Benchmark name: (function writing its input to a directory, function measuring it)
+BENCHMARKS = {
+	'contact_loader': (prepare_contacts, bench_contact_loader),
+	'contact_selector': (prepare_contacts, bench_contact_selector),
+	'number_retriever': (prepare_phones, bench_number_retriever),
+	'snapshot_loader': (prepare_snapshot, bench_snapshot_loader)
+}
+
+def _run_in_child(function, args, results):
+	try:
+		results.put((True, function(*args)))
+	except BaseException:
+		results.put((False, traceback.format_exc()))
+
+def _call_in_child(function, *args):
+	"""
+	Call function(*args) in a fresh process and return its result. An
+	exception in the child is raised here as a RuntimeError holding its
+	traceback, as is the child dying without reporting back.
+	"""
+	results = multiprocessing.Queue()
+	process = multiprocessing.Process(target = _run_in_child, args = (function, args, results))
+	process.start()
+	try:
+		while True:
+			try:
+				succeeded, result = results.get(timeout = 1)
+				break
+			except Queue.Empty:
+				if not process.is_alive():
+					# Anything it sent has arrived by the time it has exited
+					try:
+						succeeded, result = results.get(timeout = 1)
+						break
+					except Queue.Empty:
+						raise RuntimeError("{0} exited with code {1} without a result".format(
+							function.__name__, process.exitcode))
+	finally:
+		process.join()
+	if not succeeded:
+		raise RuntimeError("{0} failed:\n{1}".format(function.__name__, result))
+	return result
+
+def run_benchmark(name, rows, seed = 0, repeat = 1):
+	"""
+	Prepare the input for one benchmark in a fresh process, then run it
+	repeat times, each in a process of its own, and return the list of
+	measurements.
+	"""
+	prepare, measure = BENCHMARKS[name]
+	directory = tempfile.mkdtemp(prefix = 'gvbench')
+	try:
+		path = _call_in_child(prepare, rows, seed, directory)
+		return [_call_in_child(measure, path) for _ in range(repeat)]
+	finally:
+		shutil.rmtree(directory)
+
+def run_suite(names, sizes, repeat = 3, seed = 0):
+	"""
+	Run every named benchmark at every size, repeat times each, and
+	return the results. "seconds" is the best of the repeats; every run
+	is kept under "runs".
+	"""
+	results = []
+	for name in names:
+		for rows in sizes:
+			runs = run_benchmark(name, rows, seed, repeat)
+			best = min(runs, key = lambda run: run['seconds'])
+			result = dict(best)
+			result.update({'benchmark': name, 'rows': rows,
+						   'peak_rss_delta_kb': max(run['peak_rss_delta_kb'] for run in runs),
+						   'runs': [run['seconds'] for run in runs]})
+			results.append(result)
+			print "{0:<18} {1:>9} rows  {2:9.4f} s  {3:>9} KB".format(
+				name, rows, result['seconds'], result['peak_rss_delta_kb'])
+	return results
+
+# Main method to be run
+def main(argv = None):
+	parser = argparse.ArgumentParser(description = "Benchmark the gvoice contact pipeline on synthetic data.")
+	parser.add_argument('--sizes', type = int, nargs = '+', default = DEFAULT_SIZES,
+						help = "numbers of rows to generate (default 1000 to 1000000)")
+	parser.add_argument('--benchmarks', nargs = '+', choices = sorted(BENCHMARKS), default = sorted(BENCHMARKS),
+						help = "benchmarks to run (default all)")
+	parser.add_argument('--repeat', type = int, default = 3,
+						help = "runs per benchmark and size, the best is reported (default 3)")
+	parser.add_argument('--seed', type = int, default = 0,
+						help = "seed for the synthetic data (default 0)")
+	parser.add_argument('--output', default = 'bench_results.json',
+						help = "JSON file to write the results to (default bench_results.json)")
+	options = parser.parse_args(argv)
+
+	results = run_suite(options.benchmarks, options.sizes, options.repeat, options.seed)
+	with open(options.output, 'w') as output_file:
+		json.dump({
+			'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+			'python': platform.python_version(),
+			'platform': platform.platform(),
+			'seed': options.seed,
+			'repeat': options.repeat,
+			'results': results
+		}, output_file, indent = 2, sort_keys = True)
+	print "Results written to {0}".format(options.output)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,370 @@
+"""
+gvdaemon.py
+
+Keeps a logged in Google Voice session and the parsed Google Contacts in
+memory, and serves send, call and lookup requests over a small local
+HTTP API. Short lived clients then skip the login and the contacts
+download entirely.
+
+Start it with:
+
+	python gvdaemon.py                       # http://127.0.0.1:8765
+	python gvdaemon.py --socket /tmp/gv.sock # HTTP over a Unix socket
+
+API (JSON in, JSON out):
+
+	POST /send    {"number": "555-555-5555", "text": "Hello"}
+	POST /call    {"number": "555-555-5555", "forwarding_number": "...", "phone_type": 2}
+	GET  /lookup?q=smith        contacts whose name contains "smith"
+	GET  /lookup?group=Family   contacts in a group
+	GET  /groups                group names and sizes
+	POST /reload                download the contacts again
+	POST /suppress {"number": "555-555-5555"}   never contact a number again
+	                                            (needs --suppress FILE)
+
+Every request must carry the daemon's token in an X-GVDaemon-Token
+header. A new token is written to ~/.gvdaemon_token (readable by its
+owner only) each time the daemon starts. POST bodies must be sent as
+application/json, and on a TCP port the Host header must name the
+daemon itself, so web pages open in a browser cannot reach the API.
+
+From Python, use DaemonClient, which reads the token file itself:
+
+	client = DaemonClient(socket_path = '/tmp/gv.sock')
+	client.send('555-555-5555', 'Hello')
+"""
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import binascii
+import hmac
+import httplib
+import json
+import os
+import socket
+import sys
+import threading
+import urllib
+import urlparse
+
+from gvoice import *
+import gvsuppress
+import gvtrace
+
+TOKEN_HEADER = 'X-GVDaemon-Token'
+DEFAULT_TOKEN_FILE = os.path.expanduser('~/.gvdaemon_token')
+
+def write_token(path, token):
+	"""
+	Write token to path, readable by its owner only.
+	"""
+	if os.path.exists(path):
+		os.unlink(path)
+	token_file = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600), 'w')
+	with token_file:
+		token_file.write(token + '\n')
+
+def read_token(path):
+	with open(path) as token_file:
+		return token_file.read().strip()
+
+class VoiceService():
+	"""
+	The warm state behind the daemon: one GoogleVoiceLogin, a TextSender
+	and NumberDialer bound to it, and an index of the contacts.
+	"""
+	def __init__(self, gv_login):
+		self.gv_login = gv_login
+		self.text_sender = TextSender(gv_login)
+		self.number_dialer = NumberDialer(gv_login)
+		self._contacts_lock = threading.Lock()
+		self.load_contacts()
+
+	def load_contacts(self):
+		"""
+		(Re)download the contacts and rebuild the lookup index.
+		"""
+		with gvtrace.span('load contacts'):
+			contact_loader = ContactLoader(self.gv_login)
+		contacts = {}
+		for group_contacts in contact_loader.contact_group.values():
+			for contact in group_contacts:
+				contacts.setdefault((str(contact).lower(), contact.mobile), contact)
+		with self._contacts_lock:
+			self.contact_group = contact_loader.contact_group
+			self.contacts = sorted(contacts.values(), key = lambda contact: str(contact).lower())
+			self.names = [str(contact).lower() for contact in self.contacts]
+		return len(self.contacts)
+
+	def send(self, number, text):
+		return self.text_sender.send_text(number, text)
+
+	def call(self, number, forwarding_number, phone_type = None):
+		return self.number_dialer.place_call(number, forwarding_number, phone_type)
+
+	def suppress(self, number):
+		"""
+		Add number to the suppression list file. Raises ValueError if the
+		daemon was started without one, as the opt out would be lost on
+		restart, or if number has no digits.
+		"""
+		if self.gv_login.suppression_list is None or self.gv_login.suppression_list.path is None:
+			raise ValueError("No suppression list file, start gvdaemon with --suppress FILE")
+		if gvsuppress.normalize_number(number) is None:
+			raise ValueError("Not a phone number: {0}".format(number))
+		self.gv_login.suppression_list.add(number)
+		return True
+
+	def lookup(self, query = None, group = None):
+		with self._contacts_lock:
+			if group is not None:
+				found = self.contact_group.get(group, [])
+			else:
+				query = (query or '').lower()
+				found = [contact for contact, name in zip(self.contacts, self.names) if query in name]
+		return [contact_to_dict(contact) for contact in found]
+
+	def groups(self):
+		with self._contacts_lock:
+			return dict((name, len(contacts)) for name, contacts in self.contact_group.items())
+
+def contact_to_dict(contact):
+	return {
+		'first_name': contact.first_name,
+		'last_name': contact.last_name,
+		'mobile': contact.mobile,
+		'email': contact.email
+	}
+
+class DaemonRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""
+	Maps the HTTP API on to the server's VoiceService.
+	"""
+	server_version = 'gvdaemon/1.0'
+
+	def allowed(self):
+		"""
+		Check the request may use the API, replying with an error if not.
+		"""
+		if self.server.allowed_hosts is not None and self.headers.getheader('host') not in self.server.allowed_hosts:
+			self.reply(403, {'error': 'Unexpected Host header'})
+			return False
+		if not hmac.compare_digest(self.headers.getheader(TOKEN_HEADER) or '', self.server.token):
+			self.reply(401, {'error': 'Missing or wrong {0} header'.format(TOKEN_HEADER)})
+			return False
+		return True
+
+	def do_GET(self):
+		if not self.allowed():
+			return
+		url = urlparse.urlparse(self.path)
+		params = dict(urlparse.parse_qsl(url.query))
+		service = self.server.service
+		if url.path == '/lookup':
+			self.reply(200, {'contacts': service.lookup(params.get('q'), params.get('group'))})
+		elif url.path == '/groups':
+			self.reply(200, {'groups': service.groups()})
+		else:
+			self.reply(404, {'error': 'Unknown path {0}'.format(url.path)})
+
+	def do_POST(self):
+		if not self.allowed():
+			return
+		# Browsers can send text/plain and form posts without asking first
+		if (self.headers.getheader('content-type') or '').split(';')[0].strip().lower() != 'application/json':
+			self.reply(415, {'error': 'Content-Type must be application/json'})
+			return
+		url = urlparse.urlparse(self.path)
+		try:
+			length = int(self.headers.getheader('content-length') or 0)
+			body = json.loads(self.rfile.read(length) or '{}')
+		except ValueError:
+			self.reply(400, {'error': 'Request body must be JSON'})
+			return
+		service = self.server.service
+		try:
+			if url.path == '/send':
+				self.reply(200, {'success': service.send(body['number'], body['text'])})
+			elif url.path == '/call':
+				response = service.call(body['number'], body['forwarding_number'], body.get('phone_type'))
+				self.reply(200, {'response': response})
+			elif url.path == '/suppress':
+				try:
+					self.reply(200, {'suppressed': service.suppress(body['number'])})
+				except ValueError as e:
+					self.reply(409, {'error': str(e)})
+			elif url.path == '/reload':
+				self.reply(200, {'contacts': service.load_contacts()})
+			else:
+				self.reply(404, {'error': 'Unknown path {0}'.format(url.path)})
+		except KeyError as e:
+			self.reply(400, {'error': 'Missing field {0}'.format(e)})
+		except (urllib2.URLError, httplib.HTTPException, socket.error) as e:
+			self.log_error("Request to Google Voice failed: %s", e)
+			self.reply(502, {'error': 'Request to Google Voice failed: {0}'.format(e)})
+		except Exception as e:
+			self.log_error("Request failed: %r", e)
+			self.reply(500, {'error': 'Request failed: {0}'.format(e)})
+
+	def reply(self, status, payload):
+		content = json.dumps(payload)
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+
+	def address_string(self):
+		# Skip the reverse DNS lookup, and Unix socket clients have no address
+		if isinstance(self.client_address, tuple):
+			return self.client_address[0]
+		return 'unix'
+
+	def log_message(self, format, *args):
+		sys.stderr.write("%s - - [%s] %s\n" % (self.address_string(), self.log_date_time_string(), format % args))
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+class ThreadedUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+	def server_bind(self):
+		SocketServer.UnixStreamServer.server_bind(self)
+		os.chmod(self.server_address, 0600)
+		self.server_name = 'localhost'
+		self.server_port = 0
+
+def create_server(service, port = 8765, socket_path = None, token = None):
+	"""
+	Create (but do not start) a server for service, listening on
+	127.0.0.1:port or, if given, the Unix socket at socket_path.
+
+	Clients must send token with every request; if none is given a
+	random one is made, and can be read from the server's "token".
+	"""
+	if socket_path is not None:
+		if os.path.exists(socket_path):
+			os.unlink(socket_path)
+		server = ThreadedUnixHTTPServer(socket_path, DaemonRequestHandler)
+		# Only reachable by the socket's owner, and never by a browser
+		server.allowed_hosts = None
+	else:
+		server = ThreadedHTTPServer(('127.0.0.1', port), DaemonRequestHandler)
+		# Reject DNS rebinding, where a page's own host name resolves to 127.0.0.1
+		port = server.server_address[1]
+		server.allowed_hosts = ['127.0.0.1:{0}'.format(port), 'localhost:{0}'.format(port)]
+	server.service = service
+	server.token = token or binascii.hexlify(os.urandom(16))
+	return server
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+	def __init__(self, socket_path):
+		httplib.HTTPConnection.__init__(self, 'localhost')
+		self.socket_path = socket_path
+
+	def connect(self):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.connect(self.socket_path)
+
+class DaemonClient():
+	"""
+	Client for a running gvdaemon.
+
+	Example usage:
+
+	client = DaemonClient(port = 8765)
+	if client.send('555-555-5555', 'This is an example'):
+		print "Success!"
+
+	The token is read from token_file unless given. Errors reported by
+	the daemon are raised as IOError.
+	"""
+	def __init__(self, port = 8765, socket_path = None, token = None, token_file = DEFAULT_TOKEN_FILE):
+		self.port = port
+		self.socket_path = socket_path
+		self.token = token if token is not None else read_token(token_file)
+
+	def request(self, method, path, payload = None):
+		if self.socket_path is not None:
+			connection = UnixHTTPConnection(self.socket_path)
+		else:
+			connection = httplib.HTTPConnection('127.0.0.1', self.port)
+		try:
+			body = json.dumps(payload) if payload is not None else None
+			connection.request(method, path, body, {'Content-Type': 'application/json', TOKEN_HEADER: self.token})
+			response = connection.getresponse()
+			result = json.loads(response.read())
+			if response.status != 200:
+				raise IOError("gvdaemon: {0}".format(result.get('error', response.reason)))
+			return result
+		finally:
+			connection.close()
+
+	def send(self, number, text):
+		return self.request('POST', '/send', {'number': number, 'text': text})['success']
+
+	def call(self, number, forwarding_number, phone_type = None):
+		return self.request('POST', '/call', {'number': number,
+											  'forwarding_number': forwarding_number,
+											  'phone_type': phone_type})['response']
+
+	def lookup(self, query):
+		return self.request('GET', '/lookup?' + urllib.urlencode({'q': query}))['contacts']
+
+	def group(self, group):
+		return self.request('GET', '/lookup?' + urllib.urlencode({'group': group}))['contacts']
+
+	def groups(self):
+		return self.request('GET', '/groups')['groups']
+
+	def suppress(self, number):
+		return self.request('POST', '/suppress', {'number': number})['suppressed']
+
+	def reload(self):
+		return self.request('POST', '/reload')['contacts']
+
+# Main method to be run
+def main(argv = None):
+	parser = argparse.ArgumentParser(description = "Keep a Google Voice session warm and serve it over a local HTTP API.")
+	parser.add_argument('--port', type = int, default = 8765,
+						help = "port to listen on at 127.0.0.1 (default 8765)")
+	parser.add_argument('--socket', metavar = 'PATH',
+						help = "listen on a Unix socket at PATH instead of a TCP port")
+	parser.add_argument('--suppress', metavar = 'FILE',
+						help = "never text or call the numbers listed in FILE; /suppress appends to it, and is refused without one")
+	parser.add_argument('--token-file', default = DEFAULT_TOKEN_FILE, metavar = 'FILE',
+						help = "write the token clients must send to FILE (default ~/.gvdaemon_token)")
+	parser.add_argument('--trace', metavar = 'FILE',
+						help = "write a Chrome trace-event timeline to FILE on exit")
+	options = parser.parse_args(argv)
+	if options.trace:
+		gvtrace.enable(options.trace)
+
+	gv_login = GoogleVoiceLogin()
+	if not gv_login.logged_in:
+		print "Could not log in with provided credentials"
+		sys.exit(1)
+	else:
+		print "Login successful!"
+
+	if options.suppress:
+		gv_login.suppression_list = gvsuppress.SuppressionList.load(options.suppress)
+
+	service = VoiceService(gv_login)
+	server = create_server(service, options.port, options.socket)
+	write_token(options.token_file, server.token)
+	print "Loaded {0} contacts, listening on {1}".format(len(service.contacts),
+		options.socket or '127.0.0.1:{0}'.format(options.port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		if options.socket is not None and os.path.exists(options.socket):
+			os.unlink(options.socket)
+
+if __name__ == "__main__":
+	main()
@@ -12,12 +12,21 @@ it anywhere, you at least make reference to me and
 my blog where you acquired it.
 """
 
+import cookielib
 import csv
+import errno
 import sys
 import re
 import urllib
 import urllib2
 import json
+import os
+import StringIO
+import threading
+import time
+import weakref
+
+import gvtrace
 
 class GoogleVoiceLogin:
 	""" 
@@ -32,6 +41,17 @@ class GoogleVoiceLogin:
 	
 	The primary usage of a GoogleVoiceLogin object is to be passed
 	in to other constructors, such as the TextSender, or NumberDialer
+
+	Each login keeps its own cookie jar and opener, and never touches the
+	process wide urllib2 opener, so several accounts can be logged in
+	side by side. The opener may be shared by many threads at once.
+
+	If the session expires part way through a run, the TextSender and
+	NumberDialer objects created from this login notice, log in again
+	through refresh() and retry the request with the new key. If logging
+	in again fails, "refresh_failed" is set and no further attempts are
+	made (so a long run cannot lock the account with repeated password
+	logins): every request fails until log_in() succeeds.
 	"""
 
 	def __init__(self, email = None, password = None):
@@ -53,9 +73,19 @@ class GoogleVoiceLogin:
 			import getpass
 			password = getpass.getpass("Please enter your Google Account password: ")
 
-		# Set up our opener
-		self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor())
-		urllib2.install_opener(self.opener)
+		# Kept so that an expired session can be refreshed
+		self.email = email
+		self._password = password
+
+		# Optional gvsuppress.SuppressionList checked before every text and call
+		self.suppression_list = None
+		# Optional gvresults.ResultsSink told the outcome of every text and call
+		self.results_sink = None
+
+		# Set up our own opener. The cookie jar locks around every access,
+		# so requests from several threads can go through it at once.
+		self.cookie_jar = cookielib.CookieJar()
+		self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.cookie_jar))
 
 		# Define URLs
 		self.login_page_url = 'https://accounts.google.com/ServiceLogin?service=grandcentral'
@@ -63,8 +93,24 @@ class GoogleVoiceLogin:
 		self.gv_home_page_url = 'https://www.google.com/voice/#inbox'
 		self.contacts_url = 'https://www.google.com/voice/c/u/{0}/ui/ContactManager'
 
+		# Objects whose "key" must follow this login's, and the state used
+		# to hold their requests while the session is being refreshed
+		self.generation = 0
+		self._bound = weakref.WeakSet()
+		self._refresh_lock = threading.Lock()
+		self._ready = threading.Event()
+		self._ready.set()
+		self.refresh_failed = False
+
+		self._log_in()
+
+	def _log_in(self):
+		email = self.email
+		password = self._password
+
 		# Load sign in page
-		login_page_contents = self.opener.open(self.login_page_url).read()
+		with gvtrace.span('GET ServiceLogin'):
+			login_page_contents = self.opener.open(self.login_page_url).read()
 
 		# Find GALX value
 		galx_match_obj = re.search(r'name="GALX"\s*type="hidden"\n\s*value="([^"]+)"', login_page_contents, re.IGNORECASE)
@@ -80,10 +126,12 @@ class GoogleVoiceLogin:
 		})
 
 		# Login
-		self.opener.open(self.authenticate_url, login_params)
+		with gvtrace.span('POST ServiceLoginAuth'):
+			self.opener.open(self.authenticate_url, login_params)
 
 		# Open GV home page
-		gv_home_page_contents = self.opener.open(self.gv_home_page_url).read()
+		with gvtrace.span('GET voice home'):
+			gv_home_page_contents = self.opener.open(self.gv_home_page_url).read()
 
 		# Fine _rnr_se value
 		key = re.search('name="_rnr_se".*?value="(.*?)"', gv_home_page_contents)
@@ -95,10 +143,110 @@ class GoogleVoiceLogin:
 			self.key = key.group(1)
 			
 			username = email.split('@')[0]
-			contacts_content = self.opener.open(self.contacts_url.format(username)).read()
+			with gvtrace.span('GET ContactManager'):
+				contacts_content = self.opener.open(self.contacts_url.format(username)).read()
 			tok_match_obj = re.search(r"var\s+tok\s*=\s*'([^']+)'", contacts_content, re.IGNORECASE)
 			
 			self.contact_tok = tok_match_obj.group(1) if tok_match_obj.group(1) is not None else ''
+
+	def bind(self, client):
+		"""
+		Register client (ie a TextSender) so that its "key" attribute is
+		updated whenever this login is refreshed.
+		"""
+		self._bound.add(client)
+
+	def refresh(self, generation):
+		"""
+		Log in again after the session has expired, and hand the new key
+		to every bound object.
+
+		generation is the value of the "generation" attribute seen when
+		the failed request was made. If another thread has refreshed the
+		login since, nothing more is done, so a burst of failures only
+		logs in once. Once a refresh has failed, no more are tried and
+		False is returned. Returns whether the login is usable.
+		"""
+		with self._refresh_lock:
+			if self.refresh_failed:
+				return False
+			if generation == self.generation:
+				self._replace_session()
+			return self.logged_in
+
+	def log_in(self):
+		"""
+		Start a new session, ie to carry on after a failed refresh, and hand
+		the new key to every bound object. Returns whether it worked.
+		"""
+		with self._refresh_lock:
+			self._replace_session()
+			return self.logged_in
+
+	def _replace_session(self):
+		# Must be called with _refresh_lock held
+		self._ready.clear()
+		# Stays set unless the new session is confirmed
+		self.refresh_failed = True
+		try:
+			with gvtrace.span('refresh login'):
+				self.cookie_jar.clear()
+				self._log_in()
+			if self.logged_in:
+				for client in list(self._bound):
+					client.key = self.key
+				self.refresh_failed = False
+		finally:
+			self.generation += 1
+			self._ready.set()
+
+	def post(self, url, build_params):
+		"""
+		POST the result of build_params() to url and return the response
+		body. If the response shows the session has expired, the login is
+		refreshed and the request replayed once; build_params is called
+		again so it can pick up the new key. Returns '' if the session
+		could not be recovered, now or by an earlier refresh.
+		"""
+		for attempt in range(2):
+			# Hold new requests while a refresh is under way
+			self._ready.wait()
+			if self.refresh_failed:
+				break
+			generation = self.generation
+			try:
+				response = self.opener.open(url, build_params())
+				if not session_expired(response):
+					return response.read()
+			except urllib2.HTTPError as e:
+				if e.code not in (401, 403):
+					raise
+			if attempt or not self.refresh(generation):
+				break
+		return ''
+
+	def record_result(self, action, recipient, name, started, outcome):
+		"""
+		Pass the outcome of a text or call to the results sink, if any.
+		"""
+		if self.results_sink is not None:
+			self.results_sink.record(action, recipient, name, started, time.time() - started, outcome)
+
+def session_expired(response):
+	"""
+	Whether a response shows that the Google Voice session is no longer
+	logged in, ie the request was redirected to the sign in page.
+	"""
+	return 'accounts.google.com/ServiceLogin' in response.geturl()
+
+def encode_param(value):
+	"""
+	Return value ready for urllib.urlencode, which only takes str: unicode
+	(ie text decoded from JSON) is encoded as UTF-8.
+	"""
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
 			
 class ContactLoader():
 	""" 
@@ -110,8 +258,13 @@ class ContactLoader():
 	
 	contact_loader = ContactLoader(gv_login)
 	contact_selector = ContactSelector(contact_loader)
+
+	To only download the groups a campaign needs:
+
+	contact_loader = ContactLoader(gv_login, groups = ['Family', 'Coworkers'],
+	                               cache_dir = '.contacts_cache')
 	"""
-	def __init__(self, gv_login):
+	def __init__(self, gv_login, groups = None, cache_dir = None, cache_ttl = 3600, workers = 4):
 		""" 
 		Pass in a GoogleVoiceLogin object, and the persons Google Contacts
 		Will be downloaded and organized into a structure called 
@@ -121,20 +274,143 @@ class ContactLoader():
 		[(1, ('group_name', [contact_list])), (2, ('group_name', [contact_list]))]
 		
 		Which allows for easy access to any group. 
+
+		If a list of group names is given, only those groups are exported,
+		workers at a time. With a cache_dir, each group's export is kept
+		there, in a folder per account, and reused for cache_ttl seconds.
+		The "groups" attribute holds the groups asked for, or None.
 		"""
 		self.opener = gv_login.opener
+		self.contact_tok = gv_login.contact_tok
 		self.contacts_csv_url = "https://mail.google.com/mail/c/u/0/data/export"
-		self.contacts_csv_url += "?groupToExport=^Mine&exportType=ALL&out=OUTLOOK_CSV&tok={0}".format(gv_login.contact_tok)
-
-		# Load ALL Google Contacts into csv dictionary
-		self.contacts = csv.DictReader(self.opener.open(self.contacts_csv_url))
+		self.contacts_csv_url += "?groupToExport={0}&exportType={1}&out=OUTLOOK_CSV&tok={2}"
+		self.groups_url = "https://mail.google.com/mail/c/u/0/data/contactstore?type=4&out=js&max=-1&tok={0}"
+		if groups is not None:
+			# Each group only once, in the order given, so nobody is contacted twice
+			unique_groups = []
+			for group in groups:
+				if group not in unique_groups:
+					unique_groups.append(group)
+			groups = unique_groups
+		self.groups = groups
+		self.cache_dir = None
+		self.cache_ttl = cache_ttl
+		if cache_dir is not None:
+			# Keep accounts sharing a cache_dir from reading each other's contacts
+			self.cache_dir = os.path.join(cache_dir, urllib.quote(gv_login.email, ''))
+			# Made once here, before any export threads start
+			try:
+				os.makedirs(self.cache_dir)
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
 
 		# Create dictionary to store contacts and groups in an easier format
 		self.contact_group = {}
-		# Assigned each person to a group that we can get at later
+
+		if groups is None:
+			# Download ALL Google Contacts, and assign each person to
+			# a group that we can get at later
+			contacts_csv = self.export('^Mine', 'ALL')
+			with gvtrace.span('parse contacts'):
+				self.add_contacts(contacts_csv)
+		else:
+			group_ids = self.get_group_ids()
+			missing = [group for group in groups if group not in group_ids]
+			if missing:
+				raise ValueError("No such contact group: {0}".format(', '.join(missing)))
+			group_exports = self.export_groups([group_ids[group] for group in groups], workers)
+			with gvtrace.span('parse contacts'):
+				for group in groups:
+					self.add_contacts(group_exports[group_ids[group]], group)
+
+		# Load contacts into a list of tuples... 
+		# [(1, ('group_name', [contact_list])), (2, ('group_name', [contact_list]))]
+		self.contacts_by_group_list = [(id + 1, group_contact_item)
+									   for id, group_contact_item in enumerate(self.contact_group.items())]
+
+	def export(self, group_id, export_type = 'GROUP'):
+		"""
+		Download the Outlook CSV export of one group, or return it from the
+		cache if a fresh enough copy is there.
+		"""
+		cache_path = None
+		if self.cache_dir is not None:
+			cache_path = os.path.join(self.cache_dir, urllib.quote(group_id, '') + '.csv')
+			if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < self.cache_ttl:
+				with open(cache_path, 'rb') as cache_file:
+					return cache_file.read()
+
+		url = self.contacts_csv_url.format(urllib.quote(group_id, '^'), export_type, self.contact_tok)
+		with gvtrace.span('GET contacts export', group = group_id) as download_span:
+			contacts_csv = self.opener.open(url).read()
+			download_span.set(bytes = len(contacts_csv))
+
+		if cache_path is not None:
+			with open(cache_path + '.part', 'wb') as cache_file:
+				cache_file.write(contacts_csv)
+			os.rename(cache_path + '.part', cache_path)
+		return contacts_csv
+
+	def export_groups(self, group_ids, workers = 4):
+		"""
+		Export several groups in parallel. Returns a dictionary of
+		group id to CSV export.
+		"""
+		exports = {}
+		errors = []
+		pending = list(group_ids)
+		pending_lock = threading.Lock()
+
+		def work():
+			while True:
+				with pending_lock:
+					if not pending or errors:
+						return
+					group_id = pending.pop()
+				try:
+					exports[group_id] = self.export(group_id)
+				except Exception as e:
+					errors.append(e)
+
+		threads = [threading.Thread(target = work) for _ in range(min(workers, len(pending)))]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		if errors:
+			raise errors[0]
+		return exports
+
+	def get_group_ids(self):
+		"""
+		Download the list of contact groups, and return a dictionary of
+		group name to the id used to export it. System groups are listed
+		under their plain names, ie "Friends".
+		"""
+		with gvtrace.span('GET contact groups'):
+			groups_content = self.opener.open(self.groups_url.format(self.contact_tok)).read()
+		groups_match_obj = re.search(r"&&&START&&&(.*)&&&END&&&", groups_content, re.DOTALL)
+		groups_data = json.loads(groups_match_obj.group(1) if groups_match_obj else groups_content)
+		group_ids = {}
+		for group in groups_data.get('Body', {}).get('Groups', []):
+			name = group['Name']
+			if name.startswith('System Group: '):
+				name = name[len('System Group: '):]
+			group_ids[name.encode('utf-8') if isinstance(name, unicode) else name] = group['ID']
+		return group_ids
+
+	def add_contacts(self, contacts_csv, group = None):
+		"""
+		Parse a CSV export into contact_group. Contacts are filed under
+		their categories, or all under group if one is given.
+		"""
+		# Load them into csv dictionary
+		self.contacts = csv.DictReader(StringIO.StringIO(contacts_csv))
 		for row in self.contacts:
 			if row['First Name'] != '':
-				for category in row['Categories'].split(';'):
+				categories = [group] if group is not None else row['Categories'].split(';')
+				for category in categories:
 					if category == '':
 						category = 'Ungrouped'
 					if category not in self.contact_group:
@@ -142,11 +418,6 @@ class ContactLoader():
 					else:
 						self.contact_group[category].append(Contact(row))
 
-		# Load contacts into a list of tuples... 
-		# [(1, ('group_name', [contact_list])), (2, ('group_name', [contact_list]))]
-		self.contacts_by_group_list = [(id + 1, group_contact_item)
-									   for id, group_contact_item in enumerate(self.contact_group.items())]
-
 class Contact():
 	""" 
 	Simple class to contain information on each Google Contact person.
@@ -232,10 +503,9 @@ class ContactSelector():
         """
         if self.contact_list is None:
             return
-        for id in contacts_to_remove_list:
-            if id in range(0, len(self.contact_list) + 1):
-                self.contact_list[id - 1] = None
-        self.contact_list = [contact for contact in self.contact_list if contact is not None]
+        contacts_to_remove = set(id - 1 for id in contacts_to_remove_list)
+        self.contact_list = [contact for index, contact in enumerate(self.contact_list)
+                             if index not in contacts_to_remove]
 
 class NumberRetriever():
     """
@@ -249,7 +519,8 @@ class NumberRetriever():
         """
         self.opener = gv_login.opener
         self.phone_numbers_url = 'https://www.google.com/voice/settings/tab/phones'
-        phone_numbers_page_content = self.opener.open(self.phone_numbers_url).read()
+        with gvtrace.span('GET settings/tab/phones'):
+            phone_numbers_page_content = self.opener.open(self.phone_numbers_url).read()
         phone_data_match = re.search(r"<json><!\[CDATA\[(.*?)\]\]></json>", phone_numbers_page_content)
         phone_data = json.loads(phone_data_match.group(1))
         
@@ -283,28 +554,57 @@ class TextSender():
         print "Success!"
      else:
         print "Fail!"
+
+    From several threads, pass the text in and use the return value
+    instead, as "text" and "response" are shared:
+
+    if text_sender.send_text('555-555-5555', "This is an example"):
+        print "Success!"
     """
     def __init__(self, gv_login):
         """ 
         Pass in a GoogleVoiceLogin object, set the text message 
         and then call send_text
         """
+        self.gv_login = gv_login
         self.opener = gv_login.opener
         self.key = gv_login.key
         self.sms_url = 'https://www.google.com/voice/sms/send/'
         self.text = ''
+        gv_login.bind(self)
 
-    def send_text(self, phone_number):
+    def send_text(self, phone_number, text = None, contact_name = None):
         """
-        Sends a text message containing self.text to phone_number
+        Sends a text message containing text (or self.text) to phone_number,
+        and returns whether it was accepted. Numbers on the login's
+        suppression list are never sent to, and return False.
+
+        contact_name is only used to label the record passed to the
+        login's results sink.
         """
-        sms_params = urllib.urlencode({
+        if text is None:
+            text = self.text
+        started = time.time()
+        if self.gv_login.suppression_list is not None and self.gv_login.suppression_list.is_suppressed(phone_number):
+            self.gv_login.record_result('text', phone_number, contact_name, started, 'suppressed')
+            self.response = False
+            return False
+        sms_params = lambda: urllib.urlencode({
             '_rnr_se': self.key,
-            'phoneNumber': phone_number,
-            'text': self.text
+            'phoneNumber': encode_param(phone_number),
+            'text': encode_param(text)
         })
         # Send the text, display status message  
-        self.response = "true" in self.opener.open(self.sms_url, sms_params).read()
+        with gvtrace.span('POST sms/send') as send_span:
+            try:
+                response = "true" in self.gv_login.post(self.sms_url, sms_params)
+            except Exception:
+                self.gv_login.record_result('text', phone_number, contact_name, started, 'error')
+                raise
+            send_span.set(success = response)
+        self.gv_login.record_result('text', phone_number, contact_name, started, 'sent' if response else 'failed')
+        self.response = response
+        return response
 
 class NumberDialer():
     """ 
@@ -324,25 +624,51 @@ class NumberDialer():
         print "Fail!"
     """
     def __init__(self, gv_login):
+        self.gv_login = gv_login
         self.opener = gv_login.opener
         self.key = gv_login.key
         self.call_url = 'https://www.google.com/voice/call/connect/'
         self.forwarding_number = None
         self.phone_type = None
+        gv_login.bind(self)
 
-    def place_call(self, number):
+    def place_call(self, number, forwarding_number = None, phone_type = None, contact_name = None):
         """ 
         Pass in a GoogleVoiceLogin object, set the forwarding_number
         and then call place_call('number-to-call')
+
+        forwarding_number and phone_type can also be given here, which is
+        safe when several threads share the dialer. Returns the response,
+        which is empty if number is on the login's suppression list.
+
+        contact_name is only used to label the record passed to the
+        login's results sink.
         """
-        call_params = urllib.urlencode({
-            'outgoingNumber' : number,
-            'forwardingNumber' : self.forwarding_number,
+        if forwarding_number is None:
+            forwarding_number = self.forwarding_number
+        if phone_type is None:
+            phone_type = self.phone_type
+        started = time.time()
+        if self.gv_login.suppression_list is not None and self.gv_login.suppression_list.is_suppressed(number):
+            self.gv_login.record_result('call', number, contact_name, started, 'suppressed')
+            self.response = ''
+            return ''
+        call_params = lambda: urllib.urlencode({
+            'outgoingNumber' : encode_param(number),
+            'forwardingNumber' : encode_param(forwarding_number),
             'subscriberNumber' : 'undefined',
             'remember' : '0',
-            'phoneType' : self.phone_type,
+            'phoneType' : phone_type,
             '_rnr_se': self.key
         })
 
         # Send the text, display status message  
-        self.response = self.opener.open(self.call_url, call_params).read()
+        with gvtrace.span('POST call/connect'):
+            try:
+                response = self.gv_login.post(self.call_url, call_params)
+            except Exception:
+                self.gv_login.record_result('call', number, contact_name, started, 'error')
+                raise
+        self.gv_login.record_result('call', number, contact_name, started, 'sent' if response else 'failed')
+        self.response = response
+        return response
@@ -0,0 +1,219 @@
+"""
+gvpicker.py
+
+Paged, filterable contact selection for the mass contact scripts.
+
+Large groups are shown one screen at a time instead of being reprinted
+in full after every change. On terminals which support curses the list
+is a full screen view that follows the cursor, filters as you type and
+only repaints what changed. Elsewhere (Windows, or when the output is
+not a terminal) a line based pager with the same commands is used.
+
+Both accept ranges, so "100-450" or "3 7 12-20" excludes those contacts
+in one go.
+
+Example:
+
+	picker = ContactPicker(contact_selector.contact_list)
+	contact_selector.remove_from_contact_list(picker.run())
+"""
+
+import re
+import sys
+
+try:
+	import curses
+except ImportError:
+	curses = None
+
+# Contacts shown per page by the line based pager
+PAGE_SIZE = 20
+
+def parse_selection(text, count = None):
+	"""
+	Turn text such as "3, 7 100-450" into a sorted list of the one based
+	indexes it names. Ranges are inclusive and may be given either way
+	round. If count is given, indexes outside 1..count are dropped.
+	"""
+	selected = set()
+	for match in re.finditer(r"(\d+)\s*-\s*(\d+)|(\d+)", text):
+		if match.group(3) is not None:
+			selected.add(int(match.group(3)))
+		else:
+			first, last = sorted((int(match.group(1)), int(match.group(2))))
+			if count is not None:
+				first, last = max(first, 1), min(last, count)
+			selected.update(xrange(first, last + 1))
+	if count is not None:
+		selected = set(id for id in selected if 1 <= id <= count)
+	return sorted(selected)
+
+class ContactPicker():
+	"""
+	Lets the user pick which contacts in a list to leave out.
+
+	Contacts keep the one based numbers they have in the full list, even
+	while a filter is applied, so the numbers line up with
+	ContactSelector.get_contacts_list(). run() returns the numbers of the
+	excluded contacts, ready for ContactSelector.remove_from_contact_list().
+	"""
+	def __init__(self, contacts):
+		self.contacts = contacts
+		self.names = [str(contact).lower() for contact in contacts]
+		self.excluded = set()
+		self.filter = ''
+		self.shown = range(len(contacts))
+
+	def set_filter(self, text):
+		"""
+		Only show contacts whose name contains text. Narrowing the filter
+		only searches what is already shown.
+		"""
+		text = text.lower()
+		if text.startswith(self.filter):
+			candidates = self.shown
+		else:
+			candidates = xrange(len(self.contacts))
+		self.filter = text
+		self.shown = [index for index in candidates if text in self.names[index]]
+
+	def exclude(self, ids):
+		self.excluded.update(id - 1 for id in ids)
+
+	def include(self, ids):
+		self.excluded.difference_update(id - 1 for id in ids)
+
+	def apply_command(self, command):
+		"""
+		Apply a typed range command: "100-450" excludes, "+100-450" puts
+		contacts back. Returns False if nothing was recognised.
+		"""
+		ids = parse_selection(command, len(self.contacts))
+		if not ids:
+			return False
+		if command.strip().startswith('+'):
+			self.include(ids)
+		else:
+			self.exclude(ids)
+		return True
+
+	def line(self, index):
+		mark = ' ' if index in self.excluded else 'x'
+		return "[{0}] {1}: {2}".format(mark, index + 1, self.contacts[index])
+
+	def status(self):
+		return "{0} of {1} selected, {2} shown{3}".format(
+			len(self.contacts) - len(self.excluded), len(self.contacts), len(self.shown),
+			" matching '{0}'".format(self.filter) if self.filter else '')
+
+	def run(self):
+		"""
+		Show the picker and return the sorted numbers of the contacts the
+		user chose to leave out.
+		"""
+		if curses is not None and sys.stdin.isatty() and sys.stdout.isatty():
+			curses.wrapper(self._run_curses)
+		else:
+			self._run_lines()
+		return sorted(index + 1 for index in self.excluded)
+
+	def _run_lines(self):
+		page = 0
+		while True:
+			pages = max(1, (len(self.shown) + PAGE_SIZE - 1) // PAGE_SIZE)
+			page = min(page, pages - 1)
+			print '-' * 25
+			for index in self.shown[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]:
+				print self.line(index)
+			print '-' * 25
+			print "Page {0} of {1}, {2}".format(page + 1, pages, self.status())
+			command = raw_input("'n'/'p' page, '/name' filter, '3 7 100-450' exclude, '+100-450' include back.\nPress enter when finished: ").strip()
+			if command == '':
+				return
+			elif command.lower() == 'n':
+				page += 1
+			elif command.lower() == 'p':
+				page = max(0, page - 1)
+			elif command.startswith('/'):
+				self.set_filter(command[1:])
+				page = 0
+			else:
+				self.apply_command(command)
+
+	def _run_curses(self, screen):
+		curses.curs_set(0)
+		cursor = 0
+		top = 0
+		mode = None
+		typed = ''
+		while True:
+			height, width = screen.getmaxyx()
+			rows = max(1, height - 2)
+			cursor = max(0, min(cursor, len(self.shown) - 1))
+			if cursor < top:
+				top = cursor
+			elif cursor >= top + rows:
+				top = cursor - rows + 1
+
+			# curses only sends the cells that differ from the last refresh
+			screen.erase()
+			screen.addnstr(0, 0, self.status(), width - 1, curses.A_BOLD)
+			for row, index in enumerate(self.shown[top:top + rows]):
+				attribute = curses.A_REVERSE if top + row == cursor else curses.A_NORMAL
+				screen.addnstr(row + 1, 0, self.line(index), width - 1, attribute)
+			if mode == '/':
+				footer = "Search: " + typed
+			elif mode == ':':
+				footer = "Exclude (ie 100-450, +100-450 to include back): " + typed
+			else:
+				footer = "space toggle  / search  : range  a/x include/exclude shown  enter done"
+			screen.addnstr(height - 1, 0, footer, width - 1)
+			screen.refresh()
+
+			key = screen.getch()
+			if mode is not None:
+				if key in (10, 13, curses.KEY_ENTER):
+					if mode == ':':
+						self.apply_command(typed)
+					mode = None
+				elif key == 27:
+					if mode == '/':
+						self.set_filter('')
+					mode = None
+				elif key in (curses.KEY_BACKSPACE, 127, 8):
+					typed = typed[:-1]
+					if mode == '/':
+						self.set_filter(typed)
+				elif 32 <= key < 127:
+					typed += chr(key)
+					if mode == '/':
+						self.set_filter(typed)
+						cursor = 0
+			elif key in (10, 13, curses.KEY_ENTER):
+				return
+			elif key in (curses.KEY_UP, ord('k')):
+				cursor -= 1
+			elif key in (curses.KEY_DOWN, ord('j')):
+				cursor += 1
+			elif key == curses.KEY_PPAGE:
+				cursor -= rows
+			elif key == curses.KEY_NPAGE:
+				cursor += rows
+			elif key == curses.KEY_HOME:
+				cursor = 0
+			elif key == curses.KEY_END:
+				cursor = len(self.shown) - 1
+			elif key == ord(' ') and self.shown:
+				index = self.shown[cursor]
+				if index in self.excluded:
+					self.excluded.discard(index)
+				else:
+					self.excluded.add(index)
+				cursor += 1
+			elif key == ord('a'):
+				self.excluded.difference_update(self.shown)
+			elif key == ord('x'):
+				self.excluded.update(self.shown)
+			elif key in (ord('/'), ord(':')):
+				mode = chr(key)
+				typed = self.filter if mode == '/' else ''
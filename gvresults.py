@@ -0,0 +1,253 @@
+"""
+gvresults.py
+
+Structured record of every text sent and call placed.
+
+A ResultsSink takes one record per send_text() / place_call() and hands
+it to a background thread, which writes them out in batches. The send
+loop only pays for putting the record on a queue. Records can be written
+as JSON lines, CSV or to an SQLite database; the file based formats can
+rotate by size, or daily for runs lasting several days.
+
+Each record holds:
+
+	timestamp  when the request started (seconds since the epoch)
+	action     "text" or "call"
+	recipient  the number contacted
+	name       the contact's name, when known
+	latency    seconds the request took
+	outcome    "sent", "failed", "suppressed" or "error"
+
+Example:
+
+	gv_login.results_sink = open_sink('results.jsonl', max_bytes = 100 * 1024 * 1024)
+	...
+	gv_login.results_sink.close()
+"""
+
+import Queue
+import csv
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+FIELDS = ['timestamp', 'action', 'recipient', 'name', 'latency', 'outcome']
+
+def _text(value):
+	# sqlite3 only takes unicode text, while names read from the contacts
+	# CSV are UTF-8 encoded str
+	if isinstance(value, str):
+		return value.decode('utf-8', 'replace')
+	return value
+
+def _utf8(value):
+	# The csv module only writes str, while names can be unicode (ie
+	# replayed from a gvscheduled journal)
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
+
+class RotatingWriter():
+	"""
+	Base for the file writers: appends to path, and moves it aside to
+	path.1, path.2, ... once it grows past max_bytes, or at the first
+	write of a new day when daily is set.
+
+	With daily set, files are moved aside to path.YYYY-MM-DD instead,
+	named after the day they were started, and to path.YYYY-MM-DD.1,
+	path.YYYY-MM-DD.2, ... when max_bytes fills more than one a day.
+	"""
+	def __init__(self, path, max_bytes = 0, backup_count = 5, daily = False):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.backup_count = backup_count
+		self.daily = daily
+		self.file = None
+		self.day = None
+
+	def _open(self):
+		new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+		# A file left by an earlier run belongs to the day it was last written
+		self.day = time.strftime('%Y-%m-%d', time.localtime(None if new_file else os.path.getmtime(self.path)))
+		self.file = open(self.path, 'ab')
+		self.file.seek(0, os.SEEK_END)
+		if new_file:
+			self.write_header()
+
+	def _should_rotate(self):
+		if self.daily and time.strftime('%Y-%m-%d') != self.day:
+			return True
+		return self.max_bytes and self.file.tell() >= self.max_bytes
+
+	def _rotate(self):
+		self.file.close()
+		if self.daily:
+			archive = '{0}.{1}'.format(self.path, self.day)
+			number = 0
+			while os.path.exists(archive):
+				number += 1
+				archive = '{0}.{1}.{2}'.format(self.path, self.day, number)
+			os.rename(self.path, archive)
+		else:
+			oldest = '{0}.{1}'.format(self.path, self.backup_count)
+			if os.path.exists(oldest):
+				os.remove(oldest)
+			for number in range(self.backup_count - 1, 0, -1):
+				if os.path.exists('{0}.{1}'.format(self.path, number)):
+					os.rename('{0}.{1}'.format(self.path, number), '{0}.{1}'.format(self.path, number + 1))
+			os.rename(self.path, self.path + '.1')
+		self._open()
+
+	def write_batch(self, records):
+		if self.file is None:
+			self._open()
+		if self._should_rotate():
+			self._rotate()
+		self.write_records(records)
+		self.file.flush()
+
+	def write_header(self):
+		pass
+
+	def write_records(self, records):
+		raise NotImplementedError
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+class JSONLinesWriter(RotatingWriter):
+	def write_records(self, records):
+		self.file.write(''.join(json.dumps(record, sort_keys = True) + '\n' for record in records))
+
+class CSVWriter(RotatingWriter):
+	def write_header(self):
+		csv.writer(self.file).writerow(FIELDS)
+
+	def write_records(self, records):
+		csv.writer(self.file).writerows([[_utf8(record[field]) for field in FIELDS] for record in records])
+
+class SQLiteWriter():
+	"""
+	Writes records to a "results" table, one transaction per batch.
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.connection = None
+
+	def write_batch(self, records):
+		# Connect here, as SQLite connections belong to the thread which made them
+		if self.connection is None:
+			self.connection = sqlite3.connect(self.path)
+			self.connection.execute("CREATE TABLE IF NOT EXISTS results "
+									"(timestamp REAL, action TEXT, recipient TEXT, name TEXT, latency REAL, outcome TEXT)")
+		with self.connection:
+			self.connection.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)",
+										[[_text(record[field]) for field in FIELDS] for record in records])
+
+	def close(self):
+		if self.connection is not None:
+			self.connection.close()
+			self.connection = None
+
+class ResultsSink():
+	"""
+	Buffers records and writes them from a background thread, in batches
+	of up to batch_size, at least every flush_interval seconds.
+
+	A batch which cannot be written (ie the disk is full) is reported on
+	stderr and dropped, and the thread carries on with the next one.
+	close() then raises an IOError saying how many records were lost.
+	"""
+	def __init__(self, writer, batch_size = 500, flush_interval = 1.0):
+		self.writer = writer
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.dropped = 0
+		self.error = None
+		self._queue = Queue.Queue()
+		self._thread = threading.Thread(target = self._run, name = 'ResultsSink')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def record(self, action, recipient, name, started, latency, outcome):
+		"""
+		Queue one record. Cheap enough to call for every request.
+		"""
+		self._queue.put({
+			'timestamp': started,
+			'action': action,
+			'recipient': recipient,
+			'name': name,
+			'latency': latency,
+			'outcome': outcome
+		})
+
+	def _run(self):
+		closing = False
+		while not closing:
+			batch = []
+			deadline = time.time() + self.flush_interval
+			while len(batch) < self.batch_size:
+				try:
+					record = self._queue.get(timeout = max(0, deadline - time.time()))
+				except Queue.Empty:
+					break
+				if record is None:
+					closing = True
+					break
+				batch.append(record)
+			if batch:
+				self._write(batch)
+		try:
+			self.writer.close()
+		except Exception as e:
+			self._failed([], e)
+
+	def _write(self, batch):
+		try:
+			self.writer.write_batch(batch)
+		except Exception as e:
+			self._failed(batch, e)
+			# Start the next batch with a freshly opened output
+			try:
+				self.writer.close()
+			except Exception:
+				pass
+
+	def _failed(self, batch, error):
+		self.dropped += len(batch)
+		if self.error is None:
+			self.error = error
+		sys.stderr.write("Could not write {0} results: {1}\n".format(len(batch), error))
+
+	def close(self):
+		"""
+		Write out everything queued so far and close the output. Raises
+		an IOError if any records could not be written.
+		"""
+		if self._thread is not None:
+			self._queue.put(None)
+			self._thread.join()
+			self._thread = None
+			if self.error is not None:
+				raise IOError("{0} results could not be written: {1}".format(self.dropped, self.error))
+
+def open_sink(path, max_bytes = 0, backup_count = 5, daily = False, **options):
+	"""
+	Create a ResultsSink writing to path, choosing the format from its
+	extension: .csv for CSV, .db/.sqlite/.sqlite3 for SQLite, anything
+	else for JSON lines. Rotation options apply to the file formats only.
+	"""
+	extension = os.path.splitext(path)[1].lower()
+	if extension in ('.db', '.sqlite', '.sqlite3'):
+		writer = SQLiteWriter(path)
+	elif extension == '.csv':
+		writer = CSVWriter(path, max_bytes, backup_count, daily)
+	else:
+		writer = JSONLinesWriter(path, max_bytes, backup_count, daily)
+	return ResultsSink(writer, **options)
@@ -0,0 +1,297 @@
+"""
+gvscheduled.py
+
+Texts scheduled to go out at a given time.
+
+Pending texts are kept in a heap ordered by due time, so the engine can
+hold hundreds of thousands of them and only ever looks at the earliest.
+Its thread sleeps until that one is due (or an earlier one is added)
+rather than polling; see Waker. Every change is appended to a journal file, which
+is replayed on start up, so pending texts survive a restart.
+
+Example:
+
+	scheduled_sender = ScheduledSender(TextSender(gv_login), 'scheduled.journal')
+	scheduled_sender.start()
+
+	# A reminder in an hour
+	scheduled_sender.schedule('555-555-5555', "Meeting in 15 minutes", time.time() + 3600)
+
+	# 9am in the recipient's time zone, given a map of area codes to UTC offsets
+	offset = utc_offsets[area_code('555-555-5555')]
+	scheduled_sender.schedule('555-555-5555', "Good morning", next_local_time(9, utc_offset = offset))
+"""
+
+import errno
+import heapq
+import itertools
+import json
+import os
+import re
+import select
+import sys
+import threading
+import time
+
+import gvtrace
+
+def area_code(number):
+	"""
+	Return the three digit area code of a North American number, or None.
+	"""
+	digits = re.sub(r"\D", '', number)
+	if len(digits) == 11 and digits[0] == '1':
+		digits = digits[1:]
+	return digits[:3] if len(digits) == 10 else None
+
+def next_local_time(hour, minute = 0, utc_offset = 0, now = None):
+	"""
+	Return the next time (seconds since the epoch) at which the clock
+	reads hour:minute in a zone utc_offset hours from UTC.
+	"""
+	now = time.time() if now is None else now
+	local_now = now + utc_offset * 3600
+	day_start = local_now - local_now % 86400
+	due = day_start + hour * 3600 + minute * 60
+	if due <= local_now:
+		due += 86400
+	return due - utc_offset * 3600
+
+class Waker():
+	"""
+	Lets one thread sleep until a timeout passes or another thread wakes
+	it. On Python 2, Condition.wait(timeout) polls every 50ms or so, while
+	select() on a pipe sleeps for the whole time. Where select() cannot
+	wait on pipes (Windows), an Event is used instead.
+	"""
+	def __init__(self):
+		if os.name == 'posix':
+			import fcntl
+			self._event = None
+			self._read, self._write = os.pipe()
+			# A full pipe already means "wake up", so never block writing to it
+			fcntl.fcntl(self._write, fcntl.F_SETFL, fcntl.fcntl(self._write, fcntl.F_GETFL) | os.O_NONBLOCK)
+		else:
+			self._event = threading.Event()
+
+	def wake(self):
+		if self._event is not None:
+			self._event.set()
+			return
+		try:
+			os.write(self._write, 'x')
+		except OSError as e:
+			if e.errno != errno.EAGAIN:
+				raise
+
+	def sleep(self, timeout = None):
+		"""
+		Return after timeout seconds (never, if None), or as soon as wake()
+		is called. A wake() since the last sleep() returns at once.
+		"""
+		if self._event is not None:
+			self._event.wait(timeout)
+			self._event.clear()
+		elif select.select([self._read], [], [], timeout)[0]:
+			os.read(self._read, 4096)
+
+class ScheduledText():
+	"""
+	One text waiting for its due time.
+	"""
+	def __init__(self, id, due, phone_number, text, contact_name = None, attempts = 0):
+		self.id = id
+		self.due = due
+		self.phone_number = phone_number
+		self.text = text
+		self.contact_name = contact_name
+		self.attempts = attempts
+
+	def to_dict(self):
+		return {
+			'id': self.id,
+			'due': self.due,
+			'phone_number': self.phone_number,
+			'text': self.text,
+			'contact_name': self.contact_name,
+			'attempts': self.attempts
+		}
+
+class ScheduledSender():
+	"""
+	Sends texts through text_sender when they fall due.
+
+	journal_path is the file pending texts are kept in. A text which fails
+	is tried again retry_delay seconds later, up to max_attempts times in
+	all.
+	"""
+	def __init__(self, text_sender, journal_path, max_attempts = 3, retry_delay = 60):
+		self.text_sender = text_sender
+		self.journal_path = journal_path
+		self.max_attempts = max_attempts
+		self.retry_delay = retry_delay
+		self.sent = 0
+		self.failed = 0
+		self._pending = {}
+		self._heap = []
+		self._ids = itertools.count(1)
+		self._journal_lines = 0
+		self._lock = threading.Lock()
+		self._waker = Waker()
+		self._thread = None
+		self._stopping = False
+		self._replay()
+
+	def _replay(self):
+		"""
+		Rebuild the pending texts from the journal, then rewrite it so it
+		only holds those.
+		"""
+		last_id = 0
+		if os.path.exists(self.journal_path):
+			with open(self.journal_path) as journal:
+				for line in journal:
+					try:
+						entry = json.loads(line)
+					except ValueError:
+						# A line cut short by a crash
+						continue
+					if entry['op'] == 'add':
+						scheduled_text = ScheduledText(**entry['text'])
+						self._pending[scheduled_text.id] = scheduled_text
+						last_id = max(last_id, scheduled_text.id)
+					elif entry['op'] == 'done':
+						self._pending.pop(entry['id'], None)
+		self._ids = itertools.count(last_id + 1)
+		self._heap = [(scheduled_text.due, scheduled_text.id) for scheduled_text in self._pending.values()]
+		heapq.heapify(self._heap)
+		self._compact()
+
+	def _compact(self):
+		with open(self.journal_path + '.part', 'w') as journal:
+			for scheduled_text in self._pending.values():
+				journal.write(json.dumps({'op': 'add', 'text': scheduled_text.to_dict()}) + '\n')
+		os.rename(self.journal_path + '.part', self.journal_path)
+		self._journal = open(self.journal_path, 'a')
+		self._journal_lines = len(self._pending)
+
+	def _write(self, entry):
+		self._journal.write(json.dumps(entry) + '\n')
+		self._journal.flush()
+		self._journal_lines += 1
+		# Keep the journal from growing without bound over a long run
+		if self._journal_lines > 2 * len(self._pending) + 10000:
+			self._journal.close()
+			self._compact()
+
+	def schedule(self, phone_number, text, due, contact_name = None):
+		"""
+		Send text to phone_number at due (seconds since the epoch).
+		Returns an id which can be passed to cancel().
+		"""
+		with self._lock:
+			scheduled_text = ScheduledText(next(self._ids), due, phone_number, text, contact_name)
+			self._add(scheduled_text)
+		return scheduled_text.id
+
+	def _add(self, scheduled_text):
+		self._pending[scheduled_text.id] = scheduled_text
+		self._write({'op': 'add', 'text': scheduled_text.to_dict()})
+		earliest = self._heap[0][0] if self._heap else None
+		heapq.heappush(self._heap, (scheduled_text.due, scheduled_text.id))
+		# Only wake the engine if it now has to send sooner
+		if earliest is None or scheduled_text.due < earliest:
+			self._waker.wake()
+
+	def cancel(self, id):
+		"""
+		Cancel a scheduled text. Returns False if it was already sent.
+		"""
+		with self._lock:
+			if self._pending.pop(id, None) is None:
+				return False
+			# Its heap entry is skipped when it comes up
+			self._write({'op': 'done', 'id': id, 'outcome': 'cancelled'})
+			return True
+
+	def pending(self):
+		"""
+		Number of texts waiting to be sent.
+		"""
+		with self._lock:
+			return len(self._pending)
+
+	def _next_due(self):
+		"""
+		Pop the next text due now, or return how long to wait for one
+		(None if nothing is pending). Must be called with the lock held.
+		"""
+		while self._heap:
+			due, id = self._heap[0]
+			scheduled_text = self._pending.get(id)
+			if scheduled_text is None or scheduled_text.due != due:
+				heapq.heappop(self._heap)
+				continue
+			wait = due - time.time()
+			if wait > 0:
+				return wait
+			heapq.heappop(self._heap)
+			del self._pending[id]
+			return scheduled_text
+		return None
+
+	def _run(self):
+		while True:
+			with self._lock:
+				if self._stopping:
+					return
+				next_due = self._next_due()
+			if isinstance(next_due, ScheduledText):
+				self._send(next_due)
+			else:
+				# A text scheduled (or stop() called) after the lock was
+				# released wakes this straight away
+				self._waker.sleep(next_due)
+
+	def _send(self, scheduled_text):
+		scheduled_text.attempts += 1
+		try:
+			with gvtrace.span('scheduled text', id = scheduled_text.id):
+				response = self.text_sender.send_text(scheduled_text.phone_number, scheduled_text.text,
+													  contact_name = scheduled_text.contact_name)
+		except Exception as e:
+			sys.stderr.write("Scheduled text {0} failed on attempt {1}: {2!r}\n".format(
+				scheduled_text.id, scheduled_text.attempts, e))
+			response = False
+		with self._lock:
+			if response:
+				self.sent += 1
+				self._write({'op': 'done', 'id': scheduled_text.id, 'outcome': 'sent'})
+			elif scheduled_text.attempts < self.max_attempts:
+				scheduled_text.due = time.time() + self.retry_delay
+				self._add(scheduled_text)
+			else:
+				self.failed += 1
+				self._write({'op': 'done', 'id': scheduled_text.id, 'outcome': 'failed'})
+
+	def start(self):
+		"""
+		Start sending on a background thread.
+		"""
+		if self._thread is None:
+			self._stopping = False
+			self._thread = threading.Thread(target = self._run, name = 'ScheduledSender')
+			self._thread.daemon = True
+			self._thread.start()
+
+	def stop(self):
+		"""
+		Stop sending after the text in progress. Pending texts stay in the
+		journal for next time.
+		"""
+		with self._lock:
+			self._stopping = True
+		self._waker.wake()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
@@ -0,0 +1,255 @@
+"""
+gvscheduler.py
+
+A scheduler which sits in front of a single TextSender and takes texts
+from several campaigns at once.
+
+Every campaign belongs to a priority class. A queued text in a higher
+class is always sent before any text in a lower one, so an urgent alert
+only ever waits for the send already in progress. Campaigns sharing a
+class are interleaved by weighted fair queuing: each campaign gets a
+share of the sends in proportion to its weight, no matter how much it
+has queued.
+
+Example:
+
+	scheduler = SendScheduler(TextSender(gv_login), pace = 1)
+	alerts = scheduler.add_campaign('alerts', priority = URGENT)
+	announcement = scheduler.add_campaign('announcement', priority = BULK)
+
+	scheduler.start()
+	for contact in contacts:
+		announcement.submit(contact.mobile, "Meeting moved to Friday")
+	alerts.submit('555-555-5555', "Server room is on fire")
+
+	print alerts.stats()
+	scheduler.stop(wait = True)
+"""
+
+import collections
+import sys
+import threading
+import time
+
+import gvtrace
+
+# Priority classes, highest first
+URGENT = 0
+NORMAL = 1
+BULK = 2
+
+# Number of recent wait times kept for the percentile in stats()
+WAIT_WINDOW = 1000
+
+class QueuedText():
+	"""
+	A single text waiting in (or sent from) a campaign queue.
+
+	Once sent, "started" holds the time the send began, "sent" the time
+	it completed and "response" the TextSender result. If send_text()
+	raised, "response" is False and "error" holds the exception.
+	"""
+	def __init__(self, campaign, phone_number, text, callback, finish_tag):
+		self.campaign = campaign
+		self.phone_number = phone_number
+		self.text = text
+		self.callback = callback
+		self.finish_tag = finish_tag
+		self.queued = time.time()
+		self.started = None
+		self.sent = None
+		self.response = None
+		self.error = None
+
+class Campaign():
+	"""
+	A queue of texts belonging to one campaign. Create these with
+	SendScheduler.add_campaign() rather than directly.
+	"""
+	def __init__(self, scheduler, name, priority, weight):
+		self.scheduler = scheduler
+		self.name = name
+		self.priority = priority
+		self.weight = float(weight)
+		self.queue = collections.deque()
+		self.last_finish_tag = 0.0
+		self.sent = 0
+		self.failed = 0
+		self.total_wait = 0.0
+		self.max_wait = 0.0
+		self.recent_waits = collections.deque(maxlen = WAIT_WINDOW)
+
+	def submit(self, phone_number, text, callback = None):
+		"""
+		Queue text for phone_number. If given, callback(queued_text) is
+		called from the scheduler thread once it has been sent (or has
+		failed). An exception raised by callback is reported on stderr.
+		"""
+		return self.scheduler._submit(self, phone_number, text, callback)
+
+	def depth(self):
+		"""
+		Number of texts still waiting to be sent.
+		"""
+		with self.scheduler._lock:
+			return len(self.queue)
+
+	def stats(self):
+		"""
+		Return a dictionary describing the queue: its depth, how many texts
+		were sent and failed, and the mean, 95th percentile and maximum
+		time (in seconds) texts waited before being sent.
+		"""
+		with self.scheduler._lock:
+			waits = sorted(self.recent_waits)
+			done = self.sent + self.failed
+			return {
+				'name': self.name,
+				'priority': self.priority,
+				'depth': len(self.queue),
+				'sent': self.sent,
+				'failed': self.failed,
+				'mean_wait': self.total_wait / done if done else 0.0,
+				'p95_wait': waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0,
+				'max_wait': self.max_wait
+			}
+
+class SendScheduler():
+	"""
+	Feeds texts from several Campaign queues through one TextSender on a
+	background thread, by priority class and then by weighted fair share.
+
+	pace is the number of seconds to wait between sends.
+	"""
+	def __init__(self, text_sender, pace = 0):
+		self.text_sender = text_sender
+		self.pace = pace
+		self.campaigns = []
+		self._lock = threading.Lock()
+		self._work = threading.Condition(self._lock)
+		self._virtual_time = {}
+		self._thread = None
+		self._stopping = False
+		self._draining = False
+
+	def add_campaign(self, name, priority = NORMAL, weight = 1):
+		"""
+		Create and return a new Campaign queue.
+		"""
+		campaign = Campaign(self, name, priority, weight)
+		with self._lock:
+			self.campaigns.append(campaign)
+			self._virtual_time.setdefault(priority, 0.0)
+		return campaign
+
+	def _submit(self, campaign, phone_number, text, callback):
+		with self._lock:
+			if self._draining or self._stopping:
+				raise RuntimeError("Scheduler is stopping, no more texts can be queued")
+			# Weighted fair queuing: a text finishes 1/weight after the later
+			# of the class's virtual time and the campaign's previous text
+			start_tag = max(self._virtual_time[campaign.priority], campaign.last_finish_tag)
+			campaign.last_finish_tag = start_tag + 1 / campaign.weight
+			queued_text = QueuedText(campaign, phone_number, text, callback, campaign.last_finish_tag)
+			campaign.queue.append(queued_text)
+			self._work.notify()
+		return queued_text
+
+	def _next_text(self):
+		"""
+		Pop the next text to send, or return None if every queue is empty.
+		Must be called with the lock held.
+		"""
+		best = None
+		for campaign in self.campaigns:
+			if not campaign.queue:
+				continue
+			head = campaign.queue[0]
+			if best is None or (campaign.priority, head.finish_tag) < (best.priority, best.queue[0].finish_tag):
+				best = campaign
+		if best is None:
+			return None
+		queued_text = best.queue.popleft()
+		self._virtual_time[best.priority] = queued_text.finish_tag - 1 / best.weight
+		return queued_text
+
+	def _run(self):
+		while True:
+			with self._lock:
+				queued_text = self._next_text()
+				while queued_text is None:
+					if self._stopping or self._draining:
+						return
+					self._work.wait()
+					queued_text = self._next_text()
+				if self._stopping:
+					return
+
+			queued_text.started = time.time()
+			try:
+				with gvtrace.span('scheduled send', campaign = queued_text.campaign.name):
+					queued_text.response = self.text_sender.send_text(queued_text.phone_number, queued_text.text)
+			except Exception as e:
+				# Counted as failed; the scheduler carries on with the next text
+				queued_text.response = False
+				queued_text.error = e
+			queued_text.sent = time.time()
+			self._record(queued_text)
+			if queued_text.callback is not None:
+				try:
+					queued_text.callback(queued_text)
+				except Exception as e:
+					sys.stderr.write("Callback for campaign {0} failed: {1}\n".format(queued_text.campaign.name, e))
+
+			if self.pace:
+				resume = time.time() + self.pace
+				with self._lock:
+					while not self._stopping and time.time() < resume:
+						self._work.wait(resume - time.time())
+
+	def _record(self, queued_text):
+		campaign = queued_text.campaign
+		wait = queued_text.started - queued_text.queued
+		with self._lock:
+			if queued_text.response:
+				campaign.sent += 1
+			else:
+				campaign.failed += 1
+			campaign.total_wait += wait
+			campaign.max_wait = max(campaign.max_wait, wait)
+			campaign.recent_waits.append(wait)
+
+	def start(self):
+		"""
+		Start sending on a background thread.
+		"""
+		if self._thread is None:
+			# Allow a stopped scheduler to be started again
+			with self._lock:
+				self._stopping = False
+				self._draining = False
+			self._thread = threading.Thread(target = self._run, name = 'SendScheduler')
+			self._thread.daemon = True
+			self._thread.start()
+
+	def stop(self, wait = False):
+		"""
+		Stop the scheduler. With wait=True every text already queued is
+		sent first, otherwise it stops after the send in progress. Texts
+		left queued are sent if start() is called again.
+		"""
+		with self._lock:
+			if wait:
+				self._draining = True
+			else:
+				self._stopping = True
+			self._work.notify_all()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+	def stats(self):
+		"""
+		Return the stats() of every campaign.
+		"""
+		return [campaign.stats() for campaign in self.campaigns]
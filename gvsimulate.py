@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+gvsimulate.py
+
+Dry-run support for the mass contact scripts.
+
+A SimulatedTextSender stands in for a TextSender: it accepts the same
+"text" attribute and send_text() call, but instead of hitting Google
+Voice it draws a latency and an outcome from a LatencyModel and advances
+a virtual clock. Nothing is sent and nothing sleeps, so a campaign of
+thousands of recipients can be projected in well under a second.
+
+Example:
+
+	latency_model = LatencyModel(mean = 0.8, jitter = 0.3, failure_rate = 0.02)
+	text_sender = SimulatedTextSender(latency_model, pace = 5)
+	text_sender.text = "This is an example"
+	for number in numbers:
+		text_sender.send_text(number)
+	print text_sender.report()
+"""
+
+import json
+import random
+
+# Characters in the GSM 03.38 default alphabet, and those in its extension
+# table which take two septets each
+GSM_BASIC_CHARS = (u"@£$¥èéùìòÇ\nØø\rÅå"
+				   u"Δ_ΦΓΛΩΠΨΣΘΞÆæßÉ"
+				   u" !\"#¤%&'()*+,-./0123456789:;<=>?"
+				   u"¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§"
+				   u"¿abcdefghijklmnopqrstuvwxyzäöñüà")
+GSM_EXTENDED_CHARS = u"^{}\\[~]|€\f"
+
+def count_segments(text):
+	"""
+	Return the number of SMS segments needed to carry text.
+
+	Messages that fit the GSM alphabet hold 160 characters, or 153 per
+	segment once split. Anything else is sent as UCS-2, which holds 70,
+	or 67 per segment once split.
+	"""
+	if isinstance(text, str):
+		text = text.decode('utf-8', 'replace')
+	if text == u'':
+		return 1
+	length = 0
+	for char in text:
+		if char in GSM_EXTENDED_CHARS:
+			length += 2
+		elif char in GSM_BASIC_CHARS:
+			length += 1
+		else:
+			# Not GSM, count as UCS-2 instead
+			length = len(text)
+			single, multi = 70, 67
+			break
+	else:
+		single, multi = 160, 153
+	if length <= single:
+		return 1
+	return (length + multi - 1) // multi
+
+class LatencyModel():
+	"""
+	Distribution of send latencies (in seconds) and outcomes.
+
+	Either describe it with a mean, jitter and failure rate, or load the
+	samples recorded in a previous run's trace file with from_trace().
+	"""
+	def __init__(self, mean = 1.0, jitter = 0.0, failure_rate = 0.0, samples = None, seed = None):
+		self.mean = mean
+		self.jitter = jitter
+		self.failure_rate = failure_rate
+		# List of (latency, success) tuples to resample from
+		self.samples = samples
+		self.random = random.Random(seed)
+
+	@classmethod
+	def from_trace(cls, trace_path, span_name = 'POST sms/send', seed = None):
+		"""
+		Build a model from the request spans in a trace written by gvtrace.
+		Spans which raised (and so carry an "error") count as failures.
+		"""
+		with open(trace_path) as trace_file:
+			events = json.load(trace_file)['traceEvents']
+		samples = [(event['dur'] / 1000000.0,
+					'error' not in event['args'] and event['args'].get('success', True))
+				   for event in events if event['name'] == span_name]
+		if not samples:
+			raise ValueError("No '{0}' spans found in {1}".format(span_name, trace_path))
+		return cls(samples = samples, seed = seed)
+
+	def sample(self):
+		"""
+		Return a (latency, success) tuple for one simulated request.
+		"""
+		if self.samples:
+			return self.random.choice(self.samples)
+		latency = max(0.0, self.random.gauss(self.mean, self.jitter)) if self.jitter else self.mean
+		return (latency, self.random.random() >= self.failure_rate)
+
+class SimulatedTextSender():
+	"""
+	Drop-in replacement for TextSender which sends nothing.
+
+	Each send_text() call advances the virtual clock by a sampled latency
+	plus the pacing delay between sends, and records the outcome in
+	"response" just as TextSender does.
+	"""
+	def __init__(self, latency_model, pace = 0):
+		self.latency_model = latency_model
+		self.pace = pace
+		self.text = ''
+		self.response = None
+		self.clock = 0.0
+		self.requests = 0
+		self.succeeded = 0
+		self.failed = 0
+		self.segments = 0
+
+	def send_text(self, phone_number, text = None, contact_name = None):
+		"""
+		Simulate sending text (or self.text) to phone_number
+		"""
+		if self.requests and self.pace:
+			self.clock += self.pace
+		latency, self.response = self.latency_model.sample()
+		self.clock += latency
+		self.requests += 1
+		self.segments += count_segments(self.text if text is None else text)
+		if self.response:
+			self.succeeded += 1
+		else:
+			self.failed += 1
+		return self.response
+
+	def wait(self, seconds):
+		"""
+		Advance the virtual clock as a real run's sleep would, for loops
+		which pause on their own rather than through pace.
+		"""
+		self.clock += seconds
+
+	def report(self):
+		"""
+		Return a printable summary of the projected campaign.
+		"""
+		minutes, seconds = divmod(self.clock, 60)
+		hours, minutes = divmod(minutes, 60)
+		throughput = self.requests / self.clock * 60 if self.clock else 0.0
+		return "\n".join([
+			"Dry run - nothing was sent",
+			"Requests:           {0}".format(self.requests),
+			"Segments:           {0}".format(self.segments),
+			"Projected failures: {0}".format(self.failed),
+			"Projected duration: {0:d}:{1:02d}:{2:05.2f}".format(int(hours), int(minutes), seconds),
+			"Throughput:         {0:.1f} messages/minute".format(throughput)
+		])
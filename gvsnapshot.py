@@ -0,0 +1,210 @@
+"""
+gvsnapshot.py
+
+Binary snapshot of the contacts downloaded by ContactLoader.
+
+Rebuilding the contact groups from the CSV export means parsing every
+row and creating a Contact per group membership, on every start. A
+snapshot stores the parsed result instead, and SnapshotContactLoader
+opens it with mmap: nothing is read up front beyond the group list, and
+a Contact is only created when a group's members are actually looked
+at. Start up cost and memory then follow what a run uses, not the size
+of the address book.
+
+Layout (all integers little endian):
+
+	header     magic, counts, the groups the export was limited to and the
+	           offset of each section below
+	offsets    uint32 per string + 1, where each string starts in "strings"
+	strings    every distinct string, back to back
+	contacts   4 x uint32 string ids per contact: first, last, mobile, email
+	groups     3 x uint32 per group: name string id, first member, member count
+	members    uint32 contact id per group membership
+
+Example:
+
+	write_snapshot(ContactLoader(gv_login), 'contacts.snapshot')
+	...
+	contact_loader = SnapshotContactLoader('contacts.snapshot')
+	contact_selector = ContactSelector(contact_loader)
+"""
+
+import array
+import mmap
+import os
+import struct
+
+from gvoice import Contact
+
+SNAPSHOT_MAGIC = 'GVSNAP02'
+# magic, string count, contact count, group count, string id of the groups
+# the export was limited to, then the offset of each section: offsets,
+# strings, contacts, groups, members
+SNAPSHOT_HEADER = struct.Struct('<8sIIIIQQQQQ')
+# Group filter string id of an export of every contact
+ALL_GROUPS = 0xFFFFFFFF
+UINT32 = struct.Struct('<I')
+STRING_SPAN = struct.Struct('<II')
+CONTACT_RECORD = struct.Struct('<IIII')
+GROUP_RECORD = struct.Struct('<III')
+
+def _uint32_array(values):
+	numbers = array.array('I', values)
+	if struct.pack('=I', 1) != struct.pack('<I', 1):
+		numbers.byteswap()
+	return numbers
+
+def write_snapshot(contact_loader, path):
+	"""
+	Write the contacts and groups of contact_loader to path. Contacts in
+	several groups are only stored once. The groups contact_loader was
+	limited to are recorded too, and read back as the "groups" attribute
+	of SnapshotContactLoader.
+	"""
+	strings = []
+	string_ids = {}
+	def string_id(value):
+		if value not in string_ids:
+			string_ids[value] = len(strings)
+			strings.append(value.encode('utf-8') if isinstance(value, unicode) else value)
+		return string_ids[value]
+
+	groups = getattr(contact_loader, 'groups', None)
+	groups_id = ALL_GROUPS if groups is None else string_id('\n'.join(sorted(groups)))
+
+	contact_records = []
+	contact_ids = {}
+	group_records = []
+	members = []
+	for group_name, contacts in contact_loader.contact_group.items():
+		group_records.extend([string_id(group_name), len(members), len(contacts)])
+		for contact in contacts:
+			key = (contact.first_name, contact.last_name, contact.mobile, contact.email)
+			if key not in contact_ids:
+				contact_ids[key] = len(contact_records) // 4
+				contact_records.extend(string_id(value) for value in key)
+			members.append(contact_ids[key])
+
+	offsets = [0]
+	for value in strings:
+		offsets.append(offsets[-1] + len(value))
+
+	offsets_position = SNAPSHOT_HEADER.size
+	strings_position = offsets_position + 4 * len(offsets)
+	contacts_position = strings_position + offsets[-1]
+	groups_position = contacts_position + 4 * len(contact_records)
+	members_position = groups_position + 4 * len(group_records)
+
+	with open(path + '.part', 'wb') as snapshot_file:
+		snapshot_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(strings), len(contact_records) // 4,
+												 len(group_records) // 3, groups_id, offsets_position,
+												 strings_position, contacts_position, groups_position,
+												 members_position))
+		_uint32_array(offsets).tofile(snapshot_file)
+		snapshot_file.write(''.join(strings))
+		_uint32_array(contact_records).tofile(snapshot_file)
+		_uint32_array(group_records).tofile(snapshot_file)
+		_uint32_array(members).tofile(snapshot_file)
+	os.rename(path + '.part', path)
+
+class ContactView(Contact):
+	"""
+	A Contact read from a snapshot. Behaves exactly like a Contact.
+	"""
+	def __init__(self, snapshot, contact_id):
+		first_name, last_name, mobile, email = CONTACT_RECORD.unpack_from(
+			snapshot.mmap, snapshot.contacts_position + CONTACT_RECORD.size * contact_id)
+		self.first_name = snapshot.string(first_name)
+		self.last_name = snapshot.string(last_name)
+		self.mobile = snapshot.string(mobile)
+		self.email = snapshot.string(email)
+
+class GroupContacts(object):
+	"""
+	The members of one group, as a read only sequence. Each ContactView
+	is created the first time its position is read.
+	"""
+	def __init__(self, snapshot, first_member, count):
+		self.snapshot = snapshot
+		self.first_member = first_member
+		self.count = count
+		self._views = {}
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, position):
+		if isinstance(position, slice):
+			return [self[index] for index in xrange(*position.indices(self.count))]
+		if position < 0:
+			position += self.count
+		if not 0 <= position < self.count:
+			raise IndexError(position)
+		view = self._views.get(position)
+		if view is None:
+			contact_id = UINT32.unpack_from(self.snapshot.mmap,
+											self.snapshot.members_position + 4 * (self.first_member + position))[0]
+			view = self._views[position] = ContactView(self.snapshot, contact_id)
+		return view
+
+	def __iter__(self):
+		for position in xrange(self.count):
+			yield self[position]
+
+class ContactSnapshot(object):
+	"""
+	A snapshot file opened with mmap.
+	"""
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as snapshot_file:
+			self.mmap = mmap.mmap(snapshot_file.fileno(), 0, access = mmap.ACCESS_READ)
+		(magic, self.string_count, self.contact_count, self.group_count, self.groups_id,
+		 self.offsets_position, self.strings_position, self.contacts_position, self.groups_position,
+		 self.members_position) = SNAPSHOT_HEADER.unpack_from(self.mmap, 0)
+		if magic != SNAPSHOT_MAGIC:
+			self.mmap.close()
+			raise ValueError("{0} is not a contacts snapshot".format(path))
+
+	def group_filter(self):
+		"""
+		Return the sorted names of the groups the export was limited to,
+		or None if it holds every contact.
+		"""
+		if self.groups_id == ALL_GROUPS:
+			return None
+		return self.string(self.groups_id).split('\n')
+
+	def string(self, string_id):
+		start, end = STRING_SPAN.unpack_from(self.mmap, self.offsets_position + 4 * string_id)
+		return self.mmap[self.strings_position + start:self.strings_position + end]
+
+	def groups(self):
+		"""
+		Return a list of (group name, GroupContacts) in the stored order.
+		"""
+		groups = []
+		for group_id in xrange(self.group_count):
+			name, first_member, count = GROUP_RECORD.unpack_from(self.mmap,
+																 self.groups_position + GROUP_RECORD.size * group_id)
+			groups.append((self.string(name), GroupContacts(self, first_member, count)))
+		return groups
+
+	def close(self):
+		self.mmap.close()
+
+class SnapshotContactLoader():
+	"""
+	Drop in replacement for ContactLoader which reads a snapshot written
+	by write_snapshot() instead of downloading the contacts.
+
+	Provides the same "contact_group", "contacts_by_group_list" and
+	"groups" attributes, but each group is a lazy GroupContacts sequence.
+	"""
+	def __init__(self, path):
+		self.snapshot = ContactSnapshot(path)
+		self.groups = self.snapshot.group_filter()
+		groups = self.snapshot.groups()
+		self.contact_group = dict(groups)
+		self.contacts_by_group_list = [(id + 1, group_contact_item)
+									   for id, group_contact_item in enumerate(groups)]
@@ -0,0 +1,315 @@
+"""
+gvsuppress.py
+
+Suppression (opt-out / do not contact) list checked before every send.
+
+The list is kept as a plain text file with one phone number per line, so
+a STOP handler or an operator can simply append to it. Loading millions
+of numbers from text is slow, so the first load also writes a compact
+binary index next to it (<list>.idx): a sorted array of the numbers
+plus a Bloom filter in front of it. Later loads read the index straight
+into memory and only parse the lines added since it was written.
+
+A list which was rewritten rather than appended to (ie regenerated by a
+nightly export) is parsed again from scratch. To tell the two apart
+without reading the whole file, the index records the file's inode,
+size and modification time, plus a hash of the first and last few KB of
+the part it covers: a rewrite replaces the file, shrinks it, or changes
+those bytes.
+
+A lookup first asks the Bloom filter, which answers "not suppressed" for
+almost every number that is not on the list without searching it; the
+rest are confirmed exactly against the sorted array, or the set of
+numbers added since the index was built.
+
+Numbers appended to the text file while a campaign is running are picked
+up automatically (the file is checked at most once a second), and add()
+suppresses a number immediately and records it in the file.
+
+Example:
+
+	suppression_list = SuppressionList.load('do_not_contact.txt')
+	gv_login.suppression_list = suppression_list
+
+	if suppression_list.is_suppressed('555-555-5555'):
+		print "Skipping"
+"""
+
+import array
+import collections
+import hashlib
+import os
+import struct
+import threading
+import time
+from bisect import bisect_left
+
+INDEX_MAGIC = 'GVSUPIDX3\n'
+# array typecode, count, bloom size in bits, bloom hash count, bytes of the
+# text file covered, SHA-1 of the sample of those bytes, then the text
+# file's size, modification time and inode when it was read
+INDEX_HEADER = struct.Struct('<cQQBQ20sQdQ')
+# Bytes at each end of the covered part of the text file which are hashed
+SAMPLE_SIZE = 4096
+# Phone numbers need 64 bits; where a C long is smaller, doubles hold them exactly
+NUMBER_TYPECODE = 'L' if array.array('L').itemsize >= 8 else 'd'
+# Bits of Bloom filter per number, and hashes per lookup (about 1% false positives)
+BLOOM_BITS_PER_NUMBER = 10
+BLOOM_HASHES = 7
+# Seconds between checks of the text file for new numbers
+REFRESH_INTERVAL = 1.0
+
+def normalize_number(number):
+	"""
+	Reduce a phone number to an integer of its digits, dropping a leading
+	US country code, so "(555) 555-5555" and "+1 555.555.5555" match.
+	Returns None if there are no digits.
+	"""
+	if not isinstance(number, basestring):
+		number = str(number)
+	# Only ASCII digits, so unicode (ie from JSON) is handled the same way
+	digits = ''.join(char for char in number if char in '0123456789')
+	if len(digits) == 11 and digits[0] == '1':
+		digits = digits[1:]
+	return int(digits) if digits else None
+
+def file_state(path):
+	"""
+	Return (size, modification time, inode) of path. The first two change
+	whenever it is written to, the inode when it is replaced.
+	"""
+	stat = os.stat(path)
+	return (stat.st_size, stat.st_mtime, stat.st_ino)
+
+class Sample():
+	"""
+	The first and last SAMPLE_SIZE bytes of the lines fed to update().
+	"""
+	def __init__(self, head = '', tail = ''):
+		self.head = head
+		self.tail_lines = collections.deque([tail] if tail else [])
+		self.tail_size = len(tail)
+
+	@classmethod
+	def read(cls, path, length):
+		"""
+		Return the Sample of the first length bytes of the file at path.
+		"""
+		with open(path, 'rb') as list_file:
+			head = list_file.read(min(SAMPLE_SIZE, length))
+			list_file.seek(max(0, length - SAMPLE_SIZE))
+			tail = list_file.read(min(SAMPLE_SIZE, length))
+		return cls(head, tail)
+
+	def update(self, line):
+		if len(self.head) < SAMPLE_SIZE:
+			self.head = (self.head + line)[:SAMPLE_SIZE]
+		self.tail_lines.append(line)
+		self.tail_size += len(line)
+		while self.tail_size - len(self.tail_lines[0]) >= SAMPLE_SIZE:
+			self.tail_size -= len(self.tail_lines.popleft())
+
+	def digest(self):
+		return hashlib.sha1(self.head + ''.join(self.tail_lines)[-SAMPLE_SIZE:]).digest()
+
+class BloomFilter():
+	"""
+	Bit array answering "definitely not present" or "probably present".
+	"""
+	def __init__(self, size, hashes = BLOOM_HASHES, bits = None):
+		self.size = max(8, size)
+		self.hashes = hashes
+		self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+
+	def _positions(self, value):
+		# Double hashing: position i is h1 + i * h2
+		first = value
+		second = ((value * 0x9E3779B97F4A7C15) >> 17 | 1) & 0xFFFFFFFFFFFFFFFF
+		for i in xrange(self.hashes):
+			yield (first + i * second) % self.size
+
+	def add(self, value):
+		for position in self._positions(value):
+			self.bits[position >> 3] |= 1 << (position & 7)
+
+	def __contains__(self, value):
+		bits = self.bits
+		for position in self._positions(value):
+			if not bits[position >> 3] & (1 << (position & 7)):
+				return False
+		return True
+
+class SuppressionList():
+	"""
+	Set of phone numbers which must never be contacted.
+
+	Use SuppressionList.load(path) to open a list file. is_suppressed()
+	is safe to call from many threads while another calls add().
+	"""
+	def __init__(self, path = None):
+		self.path = path
+		self.numbers = array.array(NUMBER_TYPECODE)
+		self.bloom_filter = BloomFilter(0)
+		self.added = set()
+		self._covered = 0
+		self._digest = Sample().digest()
+		self._state = None
+		self._next_refresh = 0
+		self._lock = threading.Lock()
+
+	@classmethod
+	def load(cls, path):
+		"""
+		Open the list at path, using (and refreshing) its binary index.
+		"""
+		suppression_list = cls(path)
+		index_path = path + '.idx'
+		if not suppression_list._read_index(index_path):
+			suppression_list._build(index_path)
+		suppression_list.refresh(force = True)
+		return suppression_list
+
+	def _read_index(self, index_path):
+		"""
+		Load the index at index_path. Whether it still matches the text
+		file is checked by the refresh() which follows.
+		"""
+		if not os.path.exists(index_path) or not os.path.exists(self.path):
+			return False
+		with open(index_path, 'rb') as index_file:
+			if index_file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+				return False
+			(typecode, count, bloom_size, bloom_hashes, covered,
+			 digest, size, mtime, inode) = INDEX_HEADER.unpack(index_file.read(INDEX_HEADER.size))
+			# Written on another platform
+			if typecode != NUMBER_TYPECODE:
+				return False
+			numbers = array.array(NUMBER_TYPECODE)
+			numbers.fromfile(index_file, count)
+			bits = bytearray(index_file.read((bloom_size + 7) // 8))
+		self.numbers = numbers
+		self.bloom_filter = BloomFilter(bloom_size, bloom_hashes, bits)
+		self._covered = covered
+		self._digest = digest
+		self._state = (size, mtime, inode)
+		return True
+
+	def _build(self, index_path):
+		"""
+		Parse the whole text file and write a fresh index for it.
+		"""
+		numbers = set()
+		covered = 0
+		sample = Sample()
+		state = (0, 0.0, 0)
+		if os.path.exists(self.path):
+			state = file_state(self.path)
+			with open(self.path, 'rb') as list_file:
+				for line in list_file:
+					# Leave a final line without a newline for the next refresh
+					if not line.endswith('\n'):
+						break
+					covered += len(line)
+					sample.update(line)
+					number = normalize_number(line)
+					if number is not None:
+						numbers.add(number)
+		numbers = array.array(NUMBER_TYPECODE, sorted(numbers))
+		bloom_filter = BloomFilter(len(numbers) * BLOOM_BITS_PER_NUMBER)
+		for number in numbers:
+			bloom_filter.add(number)
+		self.numbers = numbers
+		self.bloom_filter = bloom_filter
+		# Numbers added earlier are either in the file now, or were taken out of it
+		self.added = set()
+		self._covered = covered
+		self._digest = sample.digest()
+		self._state = state
+
+		with open(index_path + '.part', 'wb') as index_file:
+			index_file.write(INDEX_MAGIC)
+			index_file.write(INDEX_HEADER.pack(NUMBER_TYPECODE, len(numbers), bloom_filter.size,
+											   bloom_filter.hashes, covered, self._digest, *state))
+			numbers.tofile(index_file)
+			index_file.write(bloom_filter.bits)
+		os.rename(index_path + '.part', index_path)
+
+	def refresh(self, force = False):
+		"""
+		Pick up numbers appended to the text file since it was last read,
+		or read it all again if it was rewritten rather than appended to.
+		Unless force is set, the file is checked at most once a second.
+
+		Telling an append from a rewrite only reads a few KB of the file,
+		so this stays cheap however long the list is.
+		"""
+		if self.path is None or (not force and time.time() < self._next_refresh):
+			return
+		self._next_refresh = time.time() + REFRESH_INTERVAL
+		try:
+			state = file_state(self.path)
+		except OSError:
+			return
+		if state == self._state:
+			return
+		with self._lock:
+			if state == self._state:
+				return
+			# An append keeps the same file, and leaves what was read so far unchanged
+			sample = None
+			if self._state is not None and state[2] == self._state[2] and state[0] >= self._covered:
+				sample = Sample.read(self.path, self._covered)
+			if sample is None or sample.digest() != self._digest:
+				self._build(self.path + '.idx')
+				return
+			with open(self.path, 'rb') as list_file:
+				list_file.seek(self._covered)
+				for line in list_file:
+					if not line.endswith('\n'):
+						break
+					self._covered += len(line)
+					sample.update(line)
+					number = normalize_number(line)
+					if number is not None:
+						self.added.add(number)
+			self._digest = sample.digest()
+			self._state = state
+
+	def add(self, number):
+		"""
+		Suppress number from now on, and append it to the list file.
+		"""
+		normalized = normalize_number(number)
+		if normalized is None:
+			return
+		with self._lock:
+			self.added.add(normalized)
+			if self.path is not None:
+				with open(self.path, 'a+b') as list_file:
+					line = '{0}\n'.format(normalized)
+					# Don't run on from a last line written without its newline
+					list_file.seek(0, os.SEEK_END)
+					if list_file.tell():
+						list_file.seek(-1, os.SEEK_END)
+						if list_file.read(1) != '\n':
+							line = '\n' + line
+						list_file.seek(0, os.SEEK_END)
+					list_file.write(line)
+
+	def is_suppressed(self, number):
+		"""
+		Whether number is on the list.
+		"""
+		self.refresh()
+		normalized = normalize_number(number)
+		if normalized is None:
+			return False
+		if normalized in self.added:
+			return True
+		if normalized not in self.bloom_filter:
+			return False
+		position = bisect_left(self.numbers, normalized)
+		return position < len(self.numbers) and self.numbers[position] == normalized
+
+	def __contains__(self, number):
+		return self.is_suppressed(number)
@@ -0,0 +1,168 @@
+"""
+gvtrace.py
+
+Lightweight stage tracing for the gvoice scripts.
+
+Spans are recorded with their parent/child relationships and can be
+written out as a Chrome trace-event JSON file, which can be opened in
+chrome://tracing or https://ui.perfetto.dev to inspect a run on a
+timeline.
+
+Tracing is off by default. It is turned on either by setting the
+GVOICE_TRACE environment variable to the path of the trace file to
+write, or by calling enable(path) (ie from a --trace command line flag).
+While it is off, span() hands back a shared no-op object, so the
+instrumented code pays for one global lookup and nothing more.
+
+Example:
+
+	import gvtrace
+
+	with gvtrace.span('login'):
+		gv_login = GoogleVoiceLogin()
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+
+# The active Tracer, or None when tracing is off
+tracer = None
+
+class _NullSpan(object):
+	"""
+	Stand in returned by span() when tracing is off.
+	"""
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		return False
+
+	def set(self, **args):
+		pass
+
+_NULL_SPAN = _NullSpan()
+
+class Span(object):
+	"""
+	A single timed region. Use it as a context manager; extra details
+	can be attached while it is open with set(key=value).
+	"""
+	def __init__(self, tracer, name, args):
+		self.tracer = tracer
+		self.name = name
+		self.args = args
+		self.span_id = None
+		self.parent_id = None
+		self.start = None
+
+	def __enter__(self):
+		self.tracer._push(self)
+		self.start = time.time()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		end = time.time()
+		if exc_type is not None:
+			self.args['error'] = exc_type.__name__
+		self.tracer._pop(self, end)
+		return False
+
+	def set(self, **args):
+		self.args.update(args)
+
+class Tracer(object):
+	"""
+	Collects finished spans and writes them as Chrome trace events.
+
+	Spans opened while another span is open on the same thread become
+	its children. The parent's id is stored in the event's "args" so the
+	relationship survives even when spans from several threads overlap.
+	"""
+	def __init__(self, path = None):
+		self.path = path
+		self.events = []
+		self.pid = os.getpid()
+		self.origin = time.time()
+		self._lock = threading.Lock()
+		self._local = threading.local()
+		self._next_id = 0
+
+	def span(self, name, **args):
+		return Span(self, name, args)
+
+	def _stack(self):
+		stack = getattr(self._local, 'stack', None)
+		if stack is None:
+			stack = self._local.stack = []
+		return stack
+
+	def _push(self, span):
+		stack = self._stack()
+		with self._lock:
+			self._next_id += 1
+			span.span_id = self._next_id
+		span.parent_id = stack[-1].span_id if stack else None
+		stack.append(span)
+
+	def _pop(self, span, end):
+		stack = self._stack()
+		if stack and stack[-1] is span:
+			stack.pop()
+		args = dict(span.args)
+		args['id'] = span.span_id
+		if span.parent_id is not None:
+			args['parent'] = span.parent_id
+		event = {
+			'name': span.name,
+			'ph': 'X',
+			'ts': int((span.start - self.origin) * 1000000),
+			'dur': int((end - span.start) * 1000000),
+			'pid': self.pid,
+			'tid': threading.current_thread().ident,
+			'args': args
+		}
+		with self._lock:
+			self.events.append(event)
+
+	def save(self, path = None):
+		"""
+		Write the collected spans to path (or the path given when the
+		tracer was created) in Chrome trace-event format.
+		"""
+		path = path or self.path
+		if path is None:
+			return
+		with self._lock:
+			events = list(self.events)
+		with open(path, 'w') as trace_file:
+			json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+def enable(path):
+	"""
+	Turn tracing on, writing the trace to path when the process exits.
+	Returns the active Tracer.
+	"""
+	global tracer
+	if tracer is None:
+		tracer = Tracer(path)
+		atexit.register(tracer.save)
+	else:
+		tracer.path = path
+	return tracer
+
+def span(name, **args):
+	"""
+	Return a context manager timing the enclosed block as a span called
+	name. Keyword arguments are attached to the event; trace files get
+	passed around, so never attach phone numbers, names or message text.
+	"""
+	if tracer is None:
+		return _NULL_SPAN
+	return tracer.span(name, **args)
+
+if os.environ.get('GVOICE_TRACE'):
+	enable(os.environ['GVOICE_TRACE'])
@@ -0,0 +1,204 @@
+"""
+gvvoicemail.py
+
+Bulk export of Google Voice voicemails and their transcripts.
+
+The voicemail inbox is listed one page at a time, and each voicemail is
+handed to a bounded pool of download threads as soon as its page
+arrives. Audio is streamed to disk in chunks, so memory use stays flat
+however large the backlog is. Voicemails already in the archive
+directory are skipped, which makes it safe to rerun after an interrupted
+export or on a schedule.
+
+For every voicemail <id>, the archive gets:
+
+	<id>.mp3   the audio
+	<id>.json  the details Google Voice keeps for it, including the
+	           transcript in "messageText"
+
+Example:
+
+	gv_login = GoogleVoiceLogin('username', 'password')
+	voicemail_exporter = VoicemailExporter(gv_login, 'archive', workers = 8)
+	voicemail_exporter.export()
+	print voicemail_exporter.downloaded, voicemail_exporter.skipped, voicemail_exporter.failed
+"""
+
+import Queue
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+
+from gvoice import *
+import gvtrace
+
+class VoicemailLister():
+	"""
+	Lists the voicemails in a Google Voice inbox, one page at a time.
+	"""
+	def __init__(self, gv_login):
+		self.opener = gv_login.opener
+		self.voicemail_url = 'https://www.google.com/voice/inbox/recent/voicemail/?page=p{0}'
+
+	def get_page(self, page):
+		"""
+		Return the list of voicemails on the given (one based) page, each
+		a dictionary of the details Google Voice keeps for it.
+		"""
+		with gvtrace.span('GET inbox/recent/voicemail', page = page):
+			page_content = self.opener.open(self.voicemail_url.format(page)).read()
+		voicemail_data_match = re.search(r"<json><!\[CDATA\[(.*?)\]\]></json>", page_content, re.DOTALL)
+		if not voicemail_data_match:
+			return []
+		voicemail_data = json.loads(voicemail_data_match.group(1))
+		return sorted(voicemail_data.get('messages', {}).values(),
+					  key = lambda voicemail: voicemail.get('startTime'), reverse = True)
+
+	def iter_voicemails(self):
+		"""
+		Yield every voicemail, fetching the next page only when the
+		previous one has been used up.
+		"""
+		page = 1
+		seen = set()
+		while True:
+			voicemails = [voicemail for voicemail in self.get_page(page) if voicemail['id'] not in seen]
+			if not voicemails:
+				return
+			for voicemail in voicemails:
+				seen.add(voicemail['id'])
+				yield voicemail
+			page += 1
+
+class VoicemailExporter():
+	"""
+	Downloads every voicemail and transcript not yet in directory.
+
+	workers download threads share the login. At most workers * 2
+	voicemails wait in the queue, so listing never runs far ahead of
+	downloading.
+	"""
+	def __init__(self, gv_login, directory, workers = 4, chunk_size = 64 * 1024):
+		self.opener = gv_login.opener
+		self.voicemail_lister = VoicemailLister(gv_login)
+		self.audio_url = 'https://www.google.com/voice/media/send_voicemail/{0}'
+		self.directory = directory
+		self.workers = workers
+		self.chunk_size = chunk_size
+		self.downloaded = 0
+		self.skipped = 0
+		self.failed = 0
+		self._counts_lock = threading.Lock()
+
+	def audio_path(self, voicemail_id):
+		return os.path.join(self.directory, '{0}.mp3'.format(voicemail_id))
+
+	def details_path(self, voicemail_id):
+		return os.path.join(self.directory, '{0}.json'.format(voicemail_id))
+
+	def is_archived(self, voicemail_id):
+		return os.path.exists(self.audio_path(voicemail_id)) and os.path.exists(self.details_path(voicemail_id))
+
+	def download(self, voicemail):
+		"""
+		Stream one voicemail's audio to disk and save its details. Both are
+		written to a temporary name first, so a half finished file is
+		never mistaken for an archived one.
+		"""
+		voicemail_id = voicemail['id']
+		audio_path = self.audio_path(voicemail_id)
+		with gvtrace.span('GET send_voicemail', id = voicemail_id) as download_span:
+			response = self.opener.open(self.audio_url.format(voicemail_id))
+			size = 0
+			try:
+				with open(audio_path + '.part', 'wb') as audio_file:
+					chunk = response.read(self.chunk_size)
+					while chunk:
+						audio_file.write(chunk)
+						size += len(chunk)
+						chunk = response.read(self.chunk_size)
+			finally:
+				response.close()
+			download_span.set(bytes = size)
+		os.rename(audio_path + '.part', audio_path)
+
+		details_path = self.details_path(voicemail_id)
+		with open(details_path + '.part', 'w') as details_file:
+			json.dump(voicemail, details_file, indent = 2, sort_keys = True)
+		os.rename(details_path + '.part', details_path)
+
+	def _count(self, name):
+		with self._counts_lock:
+			setattr(self, name, getattr(self, name) + 1)
+
+	def _work(self, queue):
+		while True:
+			voicemail = queue.get()
+			try:
+				if voicemail is None:
+					return
+				self.download(voicemail)
+				self._count('downloaded')
+			except Exception as e:
+				sys.stderr.write("Could not download voicemail {0}: {1}\n".format(voicemail['id'], e))
+				self._count('failed')
+			finally:
+				queue.task_done()
+
+	def export(self):
+		"""
+		Download everything not yet archived. Returns the number of
+		voicemails downloaded.
+		"""
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+
+		queue = Queue.Queue(maxsize = self.workers * 2)
+		threads = [threading.Thread(target = self._work, args = (queue,)) for _ in range(self.workers)]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+
+		try:
+			with gvtrace.span('export voicemail'):
+				for voicemail in self.voicemail_lister.iter_voicemails():
+					if self.is_archived(voicemail['id']):
+						self._count('skipped')
+					else:
+						queue.put(voicemail)
+		finally:
+			for thread in threads:
+				queue.put(None)
+			for thread in threads:
+				thread.join()
+		return self.downloaded
+
+# Main method to be run
+def main(argv = None):
+	parser = argparse.ArgumentParser(description = "Download every Google Voice voicemail and transcript not yet archived.")
+	parser.add_argument('directory', help = "archive directory")
+	parser.add_argument('--workers', type = int, default = 4,
+						help = "number of parallel downloads (default 4)")
+	parser.add_argument('--trace', metavar = 'FILE',
+						help = "write a Chrome trace-event timeline to FILE on exit")
+	options = parser.parse_args(argv)
+	if options.trace:
+		gvtrace.enable(options.trace)
+
+	gv_login = GoogleVoiceLogin()
+	if not gv_login.logged_in:
+		print "Could not log in with provided credentials"
+		sys.exit(1)
+	else:
+		print "Login successful!"
+
+	voicemail_exporter = VoicemailExporter(gv_login, options.directory, options.workers)
+	voicemail_exporter.export()
+	print "Downloaded {0}, already archived {1}, failed {2}".format(
+		voicemail_exporter.downloaded, voicemail_exporter.skipped, voicemail_exporter.failed)
+
+if __name__ == "__main__":
+	main()